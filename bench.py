@@ -0,0 +1,665 @@
+# Навантажувальний тест бота: локальний фейковий Bot API + сценарії клієнтів.
+#
+#   python bench.py --sessions 500 --concurrency 50
+#   python bench.py --compare bench_results/abc1234.json
+#   python bench.py --workers 4          # роутер + 4 процеси-воркери
+#   python bench.py --startup 10         # холодний старт: порт і готовність
+#   python bench.py --routing 5000       # лінійні фільтри aiogram проти індексу
+#   python bench.py --writes 2000        # коміт на замовлення проти групового коміту
+#   python bench.py --scenario gallery   # категорія одним альбомом (порівняти з cards)
+#
+# Бот імпортується з тимчасовою копією database.db і ходить у фейковий
+# сервер замість api.telegram.org, тож нічого справжнього не відправляється.
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import count
+
+from aiohttp import ClientSession, web
+
+FAKE_TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+ADMIN = 1
+
+
+# ===== ФЕЙКОВИЙ BOT API =====
+# send*/edit* повертають Message, sendMediaGroup — список, решта методів — True.
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = {}
+        self.last_message = {}
+        self._waiters = {}
+        self._ids = count(1)
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def _message(self, data):
+        chat_id = int(data["chat_id"])
+        if "message_id" in data:
+            message_id = int(data["message_id"])
+        else:
+            message_id = self.last_message[chat_id] = next(self._ids)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text") or data.get("caption") or "",
+        }
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendMediaGroup":
+            media = json.loads(data.get("media", "[]"))
+            result = [self._message(data) for _ in media]
+        elif method.startswith(("send", "edit", "copy", "forward")) and "chat_id" in data:
+            result = self._message(data)
+        else:
+            result = True
+        for key in (data.get("chat_id"), data.get("callback_query_id")):
+            waiter = self._waiters.pop(str(key), None) if key else None
+            if waiter and not waiter.done():
+                waiter.set_result(None)
+        return web.json_response({"ok": True, "result": result})
+
+    def expect(self, *keys):
+        """Future, яка завершиться на першому запиті бота для будь-якого з ключів (chat_id або id колбека)."""
+        waiter = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._waiters[str(key)] = waiter
+        return waiter
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# ===== СЦЕНАРІЙ КЛІЄНТА =====
+def make_message(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+def make_callback(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "…",
+            },
+        },
+    }
+
+def session_steps(user_id, product_id, scenario="order", products=(), plain_id=None):
+    if scenario in ("cards", "gallery"):
+        # Клієнт переглядає всю категорію піц: картку за карткою або одним альбомом
+        if scenario == "cards":
+            views = [("product", "callback", f"product:{pid}") for pid in products]
+        else:
+            views = [("gallery", "callback", "gallery:pizza")]
+        return [
+            ("start", "message", "/start"),
+            ("catalog", "message", "🛍 Каталог"),
+            ("category", "callback", "cat:pizza"),
+            *views,
+            ("add", "callback", f"add:{product_id}"),
+            ("back", "callback", "back_catalog"),
+        ]
+    if scenario == "browse":
+        # Клієнт гортає каталог: картки з фото і без, назад, інша категорія, кошик
+        return [
+            ("start", "message", "/start"),
+            ("catalog", "message", "🛍 Каталог"),
+            ("category", "callback", "cat:pizza"),
+            ("product", "callback", f"product:{product_id}"),
+            ("back", "callback", "back_catalog"),
+            ("category", "callback", "cat:drinks"),
+            ("category", "callback", "cat:drinks"),
+            ("product", "callback", f"product:{plain_id}"),
+            ("product", "callback", f"product:{product_id}"),
+            ("add", "callback", f"add:{product_id}"),
+            ("back", "callback", "back_catalog"),
+            ("category", "callback", "cat:desserts"),
+        ]
+    return [
+        ("start", "message", "/start"),
+        ("catalog", "message", "🛍 Каталог"),
+        ("category", "callback", "cat:pizza"),
+        ("product", "callback", f"product:{product_id}"),
+        ("add", "callback", f"add:{product_id}"),
+        ("checkout", "callback", "checkout"),
+        ("name", "message", f"Клієнт {user_id}"),
+        ("phone", "message", "+380000000000"),
+        ("address", "message", "вул. Тестова 1"),
+    ]
+
+
+# ===== ЗАМІРИ =====
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "p50": round(pick(0.50), 3),
+        "p95": round(pick(0.95), 3),
+        "p99": round(pick(0.99), 3),
+        "max": round(values[-1], 3),
+        "mean": round(statistics.fmean(values), 3),
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def prepare_db(db_path):
+    """Піци для сценаріїв і напій без фото (у database.db фото є в усіх товарів)."""
+    with sqlite3.connect(db_path) as conn:
+        products = [r[0] for r in conn.execute("SELECT id FROM products WHERE category='pizza' ORDER BY id")]
+        plain_id = conn.execute("SELECT MIN(id) FROM products WHERE category='drinks'").fetchone()[0]
+        conn.execute("UPDATE products SET photo=NULL WHERE id=?", (plain_id,))
+    conn.close()
+    return products, plain_id
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+
+    workdir = tempfile.mkdtemp(prefix="pizza-bench-")
+    db_path = os.path.join(workdir, "database.db")
+    if os.path.exists(args.db):
+        shutil.copy(args.db, db_path)
+    products, plain_id = prepare_db(db_path)
+    os.environ.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "ADMIN_ID": str(ADMIN),
+        "DB_PATH": db_path,
+        "BOT_API_URL": api.url,
+        "BOT_MODE": "polling",
+    })
+    if not args.telegram_limits:
+        # Ліміти Telegram міряють не сервер, а терпіння клієнта — вимикаємо
+        os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_BURST", "1000000")
+        os.environ.setdefault("THROTTLE", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as app
+
+    from aiogram.types import Update
+
+    await app.startup()
+    rss_start = rss_kb()
+    db_busy_start = app.db.stats()["busy_ms"]
+
+    latencies = []
+    per_step = {}
+    update_ids = count(1)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def feed(step, raw):
+        update = Update.model_validate(raw, context={"bot": app.bot})
+        started = time.perf_counter()
+        await app.dp.feed_update(app.bot, update)
+        ms = (time.perf_counter() - started) * 1000
+        latencies.append(ms)
+        per_step.setdefault(step, []).append(ms)
+
+    async def session(n):
+        async with slots:
+            user_id = 10_000 + n
+            product_id = products[n % len(products)]
+            for step, kind, payload in session_steps(user_id, product_id, args.scenario, products, plain_id):
+                if kind == "message":
+                    await feed(step, make_message(next(update_ids), user_id, payload))
+                    continue
+                raw = make_callback(next(update_ids), user_id, payload)
+                # Кнопки натискаються на останньому повідомленні бота в цьому чаті
+                raw["callback_query"]["message"]["message_id"] = api.last_message.get(user_id, 0)
+                await feed(step, raw)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(n) for n in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "scenario": args.scenario,
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "telegram_limits": args.telegram_limits,
+        },
+        "updates": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": percentiles(latencies),
+        "per_step_ms": {step: percentiles(values) for step, values in per_step.items()},
+        "sqlite": {
+            "busy_ms": round(app.db.stats()["busy_ms"] - db_busy_start, 3),
+            "pool": app.db.stats(),
+        },
+        "memory": {
+            "rss_start_kb": rss_start,
+            "rss_end_kb": rss_kb(),
+            "carts": app.carts.stats(),
+            "fsm": app.storage.stats() if isinstance(app.storage, app.SQLiteStorage) else {},
+        },
+        "api_calls": api.calls,
+        "api_calls_per_session": round(sum(api.calls.values()) / args.sessions, 2) if args.sessions else 0.0,
+    }
+
+    await app.shutdown()
+    await api.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+# Кілька процесів: bot.py запускається як роутер з WORKERS воркерами, апдейти
+# йдуть у його вебхук, а час кроку — від POST до першого запиту бота в Bot API.
+async def run_workers(args):
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+
+    workdir = tempfile.mkdtemp(prefix="pizza-bench-")
+    db_path = os.path.join(workdir, "database.db")
+    if os.path.exists(args.db):
+        shutil.copy(args.db, db_path)
+    products, plain_id = prepare_db(db_path)
+
+    port, worker_port = free_port(), free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN=FAKE_TOKEN,
+        ADMIN_ID=str(ADMIN),
+        DB_PATH=db_path,
+        BOT_API_URL=api.url,
+        BOT_MODE="webhook",
+        WEBHOOK_URL=f"http://127.0.0.1:{port}",
+        PORT=str(port),
+        WORKERS=str(args.workers),
+        WORKER_PORT=str(worker_port),
+    )
+    if not args.telegram_limits:
+        for name in ("SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+            env.setdefault(name, "1000000")
+        env.setdefault("THROTTLE", "0")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+
+    latencies = []
+    per_step = {}
+    update_ids = count(1)
+    slots = asyncio.Semaphore(args.concurrency)
+    webhook = f"http://127.0.0.1:{port}/webhook"
+
+    async with ClientSession() as http:
+        # Чекаємо, поки піднімуться роутер і всі воркери, щоб не міряти старт
+        for url in [f"http://127.0.0.1:{port}/"] + [f"http://127.0.0.1:{worker_port + i}/" for i in range(args.workers)]:
+            for _ in range(300):
+                try:
+                    async with http.get(url):
+                        break
+                except OSError:
+                    await asyncio.sleep(0.1)
+
+        async def session(n):
+            async with slots:
+                user_id = 10_000 + n
+                product_id = products[n % len(products)]
+                for step, kind, payload in session_steps(user_id, product_id, args.scenario, products, plain_id):
+                    update_id = next(update_ids)
+                    if kind == "message":
+                        raw = make_message(update_id, user_id, payload)
+                    else:
+                        raw = make_callback(update_id, user_id, payload)
+                        raw["callback_query"]["message"]["message_id"] = api.last_message.get(user_id, 0)
+                    reply = api.expect(user_id, update_id)
+                    started = time.perf_counter()
+                    async with http.post(webhook, json=raw) as response:
+                        response.raise_for_status()
+                    await asyncio.wait_for(reply, 60)
+                    ms = (time.perf_counter() - started) * 1000
+                    latencies.append(ms)
+                    per_step.setdefault(step, []).append(ms)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session(n) for n in range(args.sessions)))
+        elapsed = time.perf_counter() - started
+
+    proc.terminate()
+    await proc.wait()
+    await api.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "scenario": args.scenario,
+            "workers": args.workers,
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "telegram_limits": args.telegram_limits,
+        },
+        "updates": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": percentiles(latencies),
+        "per_step_ms": {step: percentiles(values) for step, values in per_step.items()},
+        "api_calls": api.calls,
+        "api_calls_per_session": round(sum(api.calls.values()) / args.sessions, 2) if args.sessions else 0.0,
+    }
+
+
+# Холодний старт: скільки від запуску процесу до відповіді / (порт відкрито)
+# і до 200 на /ready (міграції пройдено, кеші прогріто)
+async def run_startup(args):
+    api = FakeBotAPI()
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix="pizza-bench-")
+    db_path = os.path.join(workdir, "database.db")
+    if os.path.exists(args.db):
+        shutil.copy(args.db, db_path)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    health, ready = [], []
+
+    async with ClientSession() as http:
+        async def wait_for(url, started):
+            while True:
+                try:
+                    async with http.get(url) as response:
+                        if response.status == 200:
+                            return (time.perf_counter() - started) * 1000
+                except OSError:
+                    pass
+                await asyncio.sleep(0.005)
+
+        for _ in range(args.startup):
+            port = free_port()
+            env = dict(
+                os.environ,
+                BOT_TOKEN=FAKE_TOKEN,
+                ADMIN_ID=str(ADMIN),
+                DB_PATH=db_path,
+                BOT_API_URL=api.url,
+                BOT_MODE="webhook",
+                WEBHOOK_URL=f"http://127.0.0.1:{port}",
+                PORT=str(port),
+            )
+            started = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, script, env=env, stdout=subprocess.DEVNULL
+            )
+            health.append(await asyncio.wait_for(wait_for(f"http://127.0.0.1:{port}/", started), 60))
+            ready.append(await asyncio.wait_for(wait_for(f"http://127.0.0.1:{port}/ready", started), 60))
+            proc.terminate()
+            await proc.wait()
+
+    await api.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"startup_runs": args.startup},
+        "health_ms": percentiles(health),
+        "ready_ms": percentiles(ready),
+    }
+
+
+async def run_routing(args):
+    # Без мережі: N кнопок і N префіксів callback, апдейт б'є в останній
+    # зареєстрований маршрут — найгірший випадок для перебору фільтрів.
+    os.environ.update({"BOT_TOKEN": FAKE_TOKEN, "ADMIN_ID": str(ADMIN), "BOT_MODE": "polling"})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as app
+
+    from aiogram import Dispatcher, F
+    from aiogram.types import Update
+
+    async def noop(event):
+        pass
+
+    def linear(n):
+        dp = Dispatcher()
+        for i in range(n):
+            dp.message(F.text == f"button {i}")(noop)
+            dp.callback_query(F.data.startswith(f"p{i}:"))(noop)
+        return dp
+
+    def indexed(n):
+        dp = Dispatcher()
+        routes = app.Routes()
+        dp.message.outer_middleware(routes)
+        dp.callback_query.outer_middleware(routes)
+        dp.message(app.routed)(app.dispatch_route)
+        dp.callback_query(app.routed)(app.dispatch_route)
+        for i in range(n):
+            routes.text(f"button {i}")(noop)
+            routes.callback(f"p{i}")(noop)
+        return dp
+
+    async def measure(dp, n):
+        updates = [
+            Update.model_validate(make_message(1, 7, f"button {n - 1}"), context={"bot": app.bot}),
+            Update.model_validate(make_callback(2, 7, f"p{n - 1}:1"), context={"bot": app.bot}),
+        ]
+        for update in updates:
+            await dp.feed_update(app.bot, update)
+        started = time.perf_counter()
+        for i in range(args.routing):
+            await dp.feed_update(app.bot, updates[i % 2])
+        return round((time.perf_counter() - started) / args.routing * 1e6, 1)
+
+    results = {}
+    for n in (30, 100, 300):
+        results[str(n)] = {"linear_us": await measure(linear(n), n), "indexed_us": await measure(indexed(n), n)}
+        print(f"  {n:>4} маршрутів: {results[str(n)]['linear_us']:>8} мкс → {results[str(n)]['indexed_us']} мкс")
+    await app.bot.session.close()
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"routing_updates": args.routing},
+        "routing_us": results,
+    }
+
+
+async def run_writes(args):
+    # Оформлення замовлень напряму через db_save_order, args.concurrency одночасно:
+    # спершу кожне своєю транзакцією, потім через груповий коміт
+    workdir = tempfile.mkdtemp(prefix="pizza-bench-")
+    db_path = os.path.join(workdir, "database.db")
+    if os.path.exists(args.db):
+        shutil.copy(args.db, db_path)
+    os.environ.update({"BOT_TOKEN": FAKE_TOKEN, "ADMIN_ID": str(ADMIN), "DB_PATH": db_path, "BOT_MODE": "polling"})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as app
+
+    app.run_migrations()
+    await app.db.open()
+    await app.menu.load()
+    product = app.menu.products("pizza")[0]
+    cart = [{"id": product["id"], "name": product["name"], "price": product["price"], "qty": 1}]
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def order(user_id):
+        async with slots:
+            started = time.perf_counter()
+            order_id, _ = await app.db_save_order(user_id, "bench", "Bench", "+380000000000", "вул. Тестова, 1",
+                                                  cart, "• bench", product["price"])
+            latencies.append((time.perf_counter() - started) * 1000)
+            return order_id
+
+    results = {}
+    for mode, batching in (("per_order", False), ("group_commit", True)):
+        app.writer.batching = batching
+        before = app.writer.stats()
+        latencies = []
+        started = time.perf_counter()
+        ids = await asyncio.gather(*(order(100000 + n) for n in range(args.writes)))
+        elapsed = time.perf_counter() - started
+        await app.writer.stop()
+        after = app.writer.stats()
+        assert len(set(ids)) == args.writes
+        results[mode] = {
+            "orders_per_sec": round(args.writes / elapsed, 1),
+            "latency_ms": percentiles(latencies),
+            "transactions": after["batches"] - before["batches"],
+        }
+        print(f"  {mode:<13} {results[mode]['orders_per_sec']:>8} замовлень/с, "
+              f"транзакцій {results[mode]['transactions']}, p95 {results[mode]['latency_ms']['p95']} мс")
+    await app.db.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"writes": args.writes, "concurrency": args.concurrency,
+                   "window_ms": app.GROUP_COMMIT_WINDOW * 1000},
+        "writes": results,
+    }
+
+
+def compare(old, new):
+    print(f"\nПорівняння з {old.get('commit')} ({old.get('date')}):")
+    if "writes" in new:
+        for mode, row in new["writes"].items():
+            a, b = old.get("writes", {}).get(mode, {}).get("orders_per_sec"), row["orders_per_sec"]
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "—"
+            print(f"  {mode + ' orders/s':<18} {a!s:>10} → {b:<10} {change}")
+        return
+    if "routing_us" in new:
+        for n, row in new["routing_us"].items():
+            for key in ("linear_us", "indexed_us"):
+                a, b = old.get("routing_us", {}).get(n, {}).get(key), row[key]
+                change = f"{(b - a) / a * 100:+.1f}%" if a else "—"
+                print(f"  {n + ' ' + key:<18} {a!s:>10} → {b:<10} {change}")
+        return
+    if "ready_ms" in new:
+        rows = [(f"{name} {key}, ms", old[name].get(key), new[name].get(key))
+                for name in ("health_ms", "ready_ms") for key in ("p50", "p95")]
+        for name, a, b in rows:
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "—"
+            print(f"  {name:<18} {a:>10} → {b:<10} {change}")
+        return
+    rows = [("updates/sec", old["updates_per_sec"], new["updates_per_sec"])]
+    for key in ("p50", "p95", "p99"):
+        rows.append((f"latency {key}, ms", old["latency_ms"].get(key), new["latency_ms"].get(key)))
+    if "sqlite" in old and "sqlite" in new:
+        rows.append(("sqlite busy, ms", old["sqlite"]["busy_ms"], new["sqlite"]["busy_ms"]))
+    if "api_calls_per_session" in old:
+        rows.append(("API calls/session", old["api_calls_per_session"], new["api_calls_per_session"]))
+    for name, a, b in rows:
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "—"
+        print(f"  {name:<18} {a:>10} → {b:<10} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pizza-bot handlers against a fake Bot API")
+    parser.add_argument("--sessions", type=int, default=200, help="кількість сценаріїв клієнтів")
+    parser.add_argument("--scenario", choices=["order", "browse", "cards", "gallery"], default="order",
+                        help="order — повне замовлення, browse — перегляд каталогу, "
+                             "cards / gallery — вся категорія картками або альбомом")
+    parser.add_argument("--concurrency", type=int, default=20, help="скільки клієнтів одночасно")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="затримка фейкового API, мс")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="запустити bot.py окремими процесами: роутер і стільки воркерів")
+    parser.add_argument("--startup", type=int, default=0,
+                        help="заміряти холодний старт: стільки запусків bot.py")
+    parser.add_argument("--routing", type=int, default=0,
+                        help="мікробенчмарк диспетчеризації: стільки апдейтів на кожен розмір")
+    parser.add_argument("--writes", type=int, default=0,
+                        help="бенчмарк запису: стільки замовлень на кожен режим коміту")
+    parser.add_argument("--telegram-limits", action="store_true", help="не вимикати ліміти відправки і антифлуд")
+    parser.add_argument("--db", default="database.db", help="база, копія якої використовується")
+    parser.add_argument("--out", help="куди зберегти JSON (за замовчуванням bench_results/<commit>.json)")
+    parser.add_argument("--compare", help="JSON попереднього запуску для порівняння")
+    args = parser.parse_args()
+
+    if args.writes:
+        result = asyncio.run(run_writes(args))
+    elif args.routing:
+        result = asyncio.run(run_routing(args))
+    elif args.startup:
+        result = asyncio.run(run_startup(args))
+    elif args.workers:
+        result = asyncio.run(run_workers(args))
+    else:
+        result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    out = args.out or os.path.join("bench_results", f"{result['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ Результат збережено: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
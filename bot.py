@@ -1,33 +1,240 @@
+# Імпорт aiogram триває секунди, тож при запуску (python bot.py) порт для
+# health-check відкриваємо ще до нього. Далі той самий сокет забирає aiohttp.
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class EarlyHealth(BaseHTTPRequestHandler):
+    def do_GET(self):
+        alive = self.path == "/"
+        self.send_response(200 if alive else 503)
+        self.end_headers()
+        self.wfile.write(b"OK" if alive else b"starting")
+
+    def do_POST(self):
+        # Вебхук до старту: 503, Telegram повторить доставку пізніше
+        self.send_response(503)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def early_health(port):
+    server = HTTPServer(("0.0.0.0", port), EarlyHealth)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+early_server = early_health(int(os.getenv("PORT", 10000))) if __name__ == "__main__" else None
+
 import asyncio
+import cProfile
+import csv
+import hashlib
+import json
+import random
+import re
+import secrets
+import signal
 import sqlite3
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+import sys
+import tempfile
+import heapq
+import time
+from contextvars import ContextVar
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiohttp import ClientError, ClientSession, web
+from aiogram.filters import CommandObject, StateFilter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.handler import CallableObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from pydantic import PrivateAttr
 
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
+DB_PATH = os.getenv("DB_PATH", "database.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+CART_TTL = int(os.getenv("CART_TTL", 24 * 3600))
+CART_MAX = int(os.getenv("CART_MAX", 20000))
+CART_FLUSH_INTERVAL = float(os.getenv("CART_FLUSH_INTERVAL", 5))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 8))
+REDIS_URL = os.getenv("REDIS_URL")
+FSM_STORAGE = os.getenv("FSM_STORAGE", "redis" if REDIS_URL else "sqlite")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 5000))
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1))
+CART_STORAGE = os.getenv("CART_STORAGE", "redis" if REDIS_URL else "sqlite")
+# Кілька процесів: WORKERS > 1 запускає роутер і стільки ж воркерів на цій машині,
+# WORKER_URLS — адреси воркерів, запущених окремо (через кому; їм теж треба
+# задати WORKERS). Кожен воркер відправляє SEND_GLOBAL_RATE / WORKERS повідомлень
+# на секунду, щоб разом не перевищити ліміт Telegram на весь бот
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_URLS = [url.strip().rstrip("/") for url in os.getenv("WORKER_URLS", "").split(",") if url.strip()]
+WORKER_ID = int(os.getenv("WORKER_ID")) if os.getenv("WORKER_ID") else None
+WORKER_PORT = int(os.getenv("WORKER_PORT", 10100))
+WORKER_SECRET = os.getenv("WORKER_SECRET") or secrets.token_hex(16)
+MENU_POLL_INTERVAL = float(os.getenv("MENU_POLL_INTERVAL", 2))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH") or f"{os.path.splitext(DB_PATH)[0]}.archive.db"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 180))
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", 6 * 3600))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 3600))
+MAINTENANCE_PAGES = int(os.getenv("MAINTENANCE_PAGES", 256))
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "1") != "0"
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", 2)) / 1000
+GROUP_COMMIT_MAX = int(os.getenv("GROUP_COMMIT_MAX", 200))
+# Вебхук: адреса береться з WEBHOOK_URL або з домену, який дає Render/Railway
+WEBHOOK_BASE = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL") or (
+    f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else None
+)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_BASE else "polling")
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", 64))
+THROTTLE = os.getenv("THROTTLE", "1") != "0"
+THROTTLE_DEDUP_WINDOW = float(os.getenv("THROTTLE_DEDUP_WINDOW", 1))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", 10000))
+# Ліміти Telegram на відправку: загальний і на один чат
+BOT_API_URL = os.getenv("BOT_API_URL")
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+if WORKER_ID is not None:
+    SEND_GLOBAL_RATE /= WORKERS
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 5))
+# Профілювання повільних апдейтів: частка апдейтів під cProfile і поріг у мс
+PROFILE_SAMPLE = float(os.getenv("PROFILE_SAMPLE", 0))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", 500))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+# ===== МЕТРИКИ =====
+# Лічильники, гістограми і gauge у форматі Prometheus (GET /metrics).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+# Пишуть і цикл подій, і потоки пулу БД, тож зміни та знімок для render — під локом
+class Metrics:
+    def __init__(self):
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, fn, kind="gauge"):
+        """fn викликається при кожному зборі метрик."""
+        self.gauges[name] = (fn, kind)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        # Знімок під локом, форматування — вже без нього
+        with self._lock:
+            counters = list(self.counters.items())
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in self.histograms.items()]
+        gauges = list(self.gauges.items())
+
+        for name in sorted({k[0] for k, _ in counters}):
+            header(name, "counter")
+            for (n, labels), value in counters:
+                if n == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({k[0] for k, *_ in histograms}):
+            header(name, "histogram")
+            for (n, labels), counts, total, count in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(LATENCY_BUCKETS, counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, (fn, kind) in gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            header(name, kind)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_updates_total", "Оброблені апдейти за типом")
+metrics.describe("bot_update_seconds", "Повний час обробки апдейту")
+metrics.describe("bot_handler_seconds", "Час роботи хендлера")
+metrics.describe("bot_handler_errors_total", "Помилки в хендлерах")
+metrics.describe("bot_db_seconds", "Час запиту до SQLite (без очікування з'єднання)")
+metrics.describe("bot_api_seconds", "Час виклику Bot API")
+metrics.describe("bot_api_errors_total", "Помилки викликів Bot API")
 
 
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-carts = {}
-
 # ===== БАЗА ДАНИХ =====
-def init_db():
-    conn = sqlite3.connect("database.db")
-    cur = conn.cursor()
-
+# Міграції схеми. Версія зберігається в PRAGMA user_version; кожна міграція
+# виконується один раз у власній транзакції, по порядку.
+def migration_1(cur):
+    """Початкова схема: товари, замовлення, користувачі, кошики, FSM, задачі."""
     cur.execute("""
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -64,6 +271,37 @@ def init_db():
         )
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS carts (
+            user_id INTEGER PRIMARY KEY,
+            items TEXT NOT NULL,
+            updated REAL NOT NULL
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )
+    """)
+
+    # Outbox: побічні дії після замовлення (сповіщення, лічильники) виконуються воркерами
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            last_error TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)")
+
     # Додаємо початкові товари якщо таблиця порожня
     cur.execute("SELECT COUNT(*) FROM products")
     if cur.fetchone()[0] == 0:
@@ -83,118 +321,1921 @@ def init_db():
             initial_products
         )
 
-    conn.commit()
+def migration_2(cur):
+    """Позиції замовлень окремою таблицею, час як epoch і індекси для історії."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL REFERENCES orders(id),
+            product_id INTEGER,
+            name TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            price INTEGER NOT NULL
+        )
+    """)
+    cur.execute("ALTER TABLE orders ADD COLUMN created_at INTEGER")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)")
+
+def migration_3(cur):
+    """Зведені таблиці статистики (лічильники, по днях, годинах і товарах)."""
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_products (
+            name TEXT PRIMARY KEY,
+            product_id INTEGER,
+            qty INTEGER NOT NULL,
+            revenue INTEGER NOT NULL
+        )
+    """)
+    # Одноразово заповнюємо з уже перенесених замовлень; решту додасть backfill_orders
+    cur.execute("""
+        INSERT INTO stats_counters (key, value)
+        SELECT 'orders', COUNT(*) FROM orders WHERE created_at IS NOT NULL
+        UNION ALL SELECT 'revenue', COALESCE(SUM(total), 0) FROM orders WHERE created_at IS NOT NULL
+        UNION ALL SELECT 'users', COUNT(*) FROM users
+    """)
+    cur.execute("""
+        INSERT INTO stats_daily (day, orders, revenue)
+        SELECT date(created_at, 'unixepoch', 'localtime'), COUNT(*), SUM(total)
+        FROM orders WHERE created_at IS NOT NULL GROUP BY 1
+    """)
+    cur.execute("""
+        INSERT INTO stats_hourly (hour, orders, revenue)
+        SELECT strftime('%Y-%m-%d %H', created_at, 'unixepoch', 'localtime'), COUNT(*), SUM(total)
+        FROM orders WHERE created_at IS NOT NULL GROUP BY 1
+    """)
+    cur.execute("""
+        INSERT INTO stats_products (name, product_id, qty, revenue)
+        SELECT i.name, MAX(i.product_id), SUM(i.qty), SUM(i.qty * i.price)
+        FROM order_items i JOIN orders o ON o.id = i.order_id
+        WHERE o.created_at IS NOT NULL GROUP BY i.name
+    """)
+
+def migration_4(cur):
+    """Індекси для посторінкових списків товарів в адмінці."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products (category, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_no_photo ON products (id) WHERE photo IS NULL OR photo = ''")
+
+def migration_5(cur):
+    """Індекс статусів для дошки замовлень і таблиця налаштувань."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, id)")
+    cur.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+
+def migration_6(cur):
+    """Інкрементальний auto_vacuum: місце після архівації повертається у фоні."""
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+def migration_7(cur):
+    """Кеш завантажених фото: file_id за хешем вмісту файлу."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            sha256 TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            path TEXT,
+            uploaded_at INTEGER NOT NULL
+        )
+    """)
+
+MIGRATIONS = [migration_1, migration_2, migration_3, migration_4, migration_5, migration_6, migration_7]
+
+def run_migrations():
+    conn = sqlite3.connect(DB_PATH)
+    # Звичайний старт: схема актуальна, і це видно з заголовка файлу одним PRAGMA
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        conn.close()
+        return
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.isolation_level = None
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {number}")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        print(f"✅ Міграція {number}: {migration.__doc__}")
+    # Новий режим auto_vacuum набирає сили лише після повного VACUUM поза
+    # транзакцією — один раз, поки бот ще не приймає апдейти
+    if version < 6:
+        conn.execute("VACUUM")
     conn.close()
 
-def get_db():
-    return sqlite3.connect("database.db")
+# Архів старих замовлень — окремий файл з тією ж схемою, підключений до
+# кожного з'єднання пулу як schema "archive"
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.orders (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        name TEXT,
+        phone TEXT,
+        address TEXT,
+        items TEXT,
+        total INTEGER,
+        date TEXT,
+        status TEXT,
+        created_at INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.order_items (
+        id INTEGER PRIMARY KEY,
+        order_id INTEGER NOT NULL,
+        product_id INTEGER,
+        name TEXT NOT NULL,
+        qty INTEGER NOT NULL,
+        price INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_user ON orders (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_created ON orders (created_at)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_items_order ON order_items (order_id)",
+]
+ORDER_COLUMNS = "id, user_id, username, name, phone, address, items, total, date, status, created_at"
+
+def attach_archive(conn):
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_PATH,))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    for sql in ARCHIVE_SCHEMA:
+        conn.execute(sql)
+    conn.commit()
+
+# Старі замовлення (до міграції 2) мають склад лише текстом і дату рядком.
+# Переносимо їх невеликими пачками у фоні, не тримаючи блокування запису.
+LEGACY_ITEM_RE = re.compile(r"• (.+) x(\d+) — (\d+) грн")
+
+def _backfill_orders(conn, batch):
+    rows = conn.execute(
+        "SELECT id, items, date FROM orders WHERE created_at IS NULL ORDER BY id LIMIT ?", (batch,)
+    ).fetchall()
+    for order_id, items, date in rows:
+        try:
+            created_at = int(datetime.strptime(date, "%d.%m.%Y %H:%M").timestamp())
+        except (TypeError, ValueError):
+            created_at = 0
+        has_items = conn.execute("SELECT 1 FROM order_items WHERE order_id=? LIMIT 1", (order_id,)).fetchone()
+        if not has_items:
+            for name, qty, subtotal in LEGACY_ITEM_RE.findall(items or ""):
+                product = conn.execute("SELECT id FROM products WHERE name=?", (name,)).fetchone()
+                conn.execute(
+                    "INSERT INTO order_items (order_id, product_id, name, qty, price) VALUES (?,?,?,?,?)",
+                    (order_id, product[0] if product else None, name, int(qty), int(subtotal) // int(qty))
+                )
+        conn.execute("UPDATE orders SET created_at=? WHERE id=?", (created_at, order_id))
+        lines = conn.execute("SELECT product_id, name, qty, price FROM order_items WHERE order_id=?", (order_id,)).fetchall()
+        total = conn.execute("SELECT total FROM orders WHERE id=?", (order_id,)).fetchone()[0] or 0
+        apply_rollups(conn, created_at, total, lines)
+    return len(rows)
+
+async def backfill_orders(batch=500):
+    moved = 0
+    while True:
+        count = await db.run(_backfill_orders, batch)
+        moved += count
+        if count < batch:
+            break
+        await asyncio.sleep(0)
+    if moved:
+        print(f"✅ Перенесено старих замовлень: {moved}")
+
+# ===== ПУЛ З'ЄДНАНЬ =====
+# Невеликий пул довгоживучих з'єднань SQLite (WAL). Запити виконуються в окремих
+# потоках, щоб не блокувати event loop, на якому крутиться polling.
+class DBPool:
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self._conns = asyncio.Queue()
+        self._all = []
+        self._executor = None
+        self.queries = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy_total = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        attach_archive(conn)
+        return conn
+
+    async def open(self):
+        if self._executor:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db")
+        for _ in range(self.size):
+            conn = self._connect()
+            self._all.append(conn)
+            self._conns.put_nowait(conn)
+
+    async def close(self):
+        if not self._executor:
+            return
+        # Спершу дочекатись запитів, які ще виконуються в потоках, і лише потім закривати
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        for conn in self._all:
+            conn.close()
+        self._all = []
+        self._conns = asyncio.Queue()
+
+    async def run(self, fn, *args):
+        """Виконує fn(conn, *args) у потоці пулу і повертає результат."""
+        if not self._executor:
+            await self.open()
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await self._conns.get()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.queries += 1
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(self._call, conn, fn, args)
+        # З'єднання повертається в пул, коли потік справді закінчив з ним, а не
+        # коли скасували того, хто чекав: інакше його взяв би наступний запит,
+        # поки попередня транзакція ще йде в іншому потоці
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._conns.put_nowait, conn))
+        return await asyncio.wrap_future(job)
+
+    def _call(self, conn, fn, args):
+        started = time.perf_counter()
+        try:
+            # with conn: commit при успіху, rollback при помилці
+            with conn:
+                return fn(conn, *args)
+        finally:
+            spent = time.perf_counter() - started
+            self.busy_total += spent
+            metrics.observe("bot_db_seconds", [("op", fn.__name__.lstrip("_"))], spent)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(_fetchall, sql, params)
+
+    async def execute(self, sql, params=()):
+        return await self.run(_execute, sql, params)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": self._conns.qsize(),
+            "waiting": self.waiting,
+            "queries": self.queries,
+            "wait_avg_ms": round(self.wait_total / self.queries * 1000, 3) if self.queries else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "busy_ms": round(self.busy_total * 1000, 3),
+        }
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+db = DBPool(DB_PATH, DB_POOL_SIZE)
+
+# ===== ГРУПОВИЙ КОМІТ =====
+# Записи замовлень, користувачів і статусів ідуть через одного письменника:
+# усе, що накопичилось за GROUP_COMMIT_WINDOW, пишеться однією транзакцією,
+# і кожен виклик отримує свій результат через future вже після коміту.
+# Кожен запис — у власному SAVEPOINT, тож помилка одного не відкочує інших.
+# Функції запису транзакцію не відкривають — BEGIN IMMEDIATE робить письменник.
+class GroupCommit:
+    def __init__(self, pool, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX, batching=GROUP_COMMIT):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self.batching = batching
+        self._queue = asyncio.Queue()
+        self._task = None
+        self.writes = 0
+        self.batches = 0
+        self.max_size = 0
+
+    async def submit(self, fn, *args):
+        """Виконує fn(conn, *args) у спільній транзакції і повертає результат після коміту."""
+        if not self.batching:
+            return await self._commit_batch([(fn, args, None)])
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, future))
+        return await future
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            self._drain(batch)
+            if len(batch) < self.max_batch and self.window and None not in batch:
+                await asyncio.sleep(self.window)
+                self._drain(batch)
+            closing = None in batch
+            batch = [item for item in batch if item is not None and not item[2].done()]
+            if batch:
+                try:
+                    await self._commit_batch(batch)
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+            if closing:
+                return
+
+    async def _commit_batch(self, batch):
+        results = await self.pool.run(_commit_batch, [(fn, args) for fn, args, _ in batch])
+        self.writes += len(batch)
+        self.batches += 1
+        self.max_size = max(self.max_size, len(batch))
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if future is None:
+                if not ok:
+                    raise value
+                return value
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def stop(self):
+        if self._task:
+            # None у черзі — сигнал дописати все, що вже стоїть перед ним, і вийти
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "batches": self.batches,
+            "avg_batch": round(self.writes / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_size,
+        }
+
+def _commit_batch(conn, writes):
+    conn.execute("BEGIN IMMEDIATE")
+    results = []
+    for fn, args in writes:
+        conn.execute("SAVEPOINT write")
+        try:
+            results.append((True, fn(conn, *args)))
+        except Exception as e:
+            conn.execute("ROLLBACK TO write")
+            results.append((False, e))
+        conn.execute("RELEASE write")
+    return results
+
+writer = GroupCommit(db)
 
 # Отримати всі товари по категорії
-def db_get_products(category):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price, desc, photo FROM products WHERE category=?", (category,))
-    rows = cur.fetchall()
-    conn.close()
+async def db_get_products(category):
+    rows = await db.fetchall("SELECT id, name, price, desc, photo FROM products WHERE category=?", (category,))
     return [{"id": r[0], "name": r[1], "price": r[2], "desc": r[3], "photo": r[4]} for r in rows]
 
 # Отримати один товар
-def db_get_product(product_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price, desc, photo, category FROM products WHERE id=?", (product_id,))
-    r = cur.fetchone()
-    conn.close()
+async def db_get_product(product_id):
+    r = await db.fetchone("SELECT id, name, price, desc, photo, category FROM products WHERE id=?", (product_id,))
     if r:
         return {"id": r[0], "name": r[1], "price": r[2], "desc": r[3], "photo": r[4], "category": r[5]}
     return None
 
 # Додати товар
-def db_add_product(name, price, desc, photo, category):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
+async def db_add_product(name, price, desc, photo, category):
+    return await db.execute(
         "INSERT INTO products (name, price, desc, photo, category) VALUES (?,?,?,?,?)",
         (name, price, desc, photo, category)
     )
-    product_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return product_id
 
 # Видалити товар
-def db_delete_product(product_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM products WHERE id=?", (product_id,))
-    conn.commit()
-    conn.close()
+async def db_delete_product(product_id):
+    await db.execute("DELETE FROM products WHERE id=?", (product_id,))
 
 # Оновити фото товару
-def db_update_photo(product_id, photo):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE products SET photo=? WHERE id=?", (photo, product_id))
-    conn.commit()
-    conn.close()
+async def db_update_photo(product_id, photo):
+    await db.execute("UPDATE products SET photo=? WHERE id=?", (photo, product_id))
+
+# Сторінка товарів (keyset): після/перед cursor по id, з фільтром
+# "all", "nophoto" або ключ категорії. Повертає (товари, є_попередня, є_наступна).
+def _products_page(conn, flt, cursor, direction, limit):
+    where, params = [], []
+    if flt == "nophoto":
+        where.append("(photo IS NULL OR photo = '')")
+    elif flt != "all":
+        where.append("category = ?")
+        params.append(flt)
+    base = " AND ".join(where) or "1"
+    if direction == "p":
+        rows = conn.execute(
+            f"SELECT id, name, price, photo, category FROM products WHERE {base} AND id < ? ORDER BY id DESC LIMIT ?",
+            (*params, cursor, limit + 1)
+        ).fetchall()
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_next = bool(rows) and conn.execute(
+            f"SELECT 1 FROM products WHERE {base} AND id > ? LIMIT 1", (*params, rows[-1][0])
+        ).fetchone() is not None
+    else:
+        rows = conn.execute(
+            f"SELECT id, name, price, photo, category FROM products WHERE {base} AND id > ? ORDER BY id LIMIT ?",
+            (*params, cursor, limit + 1)
+        ).fetchall()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = bool(rows) and conn.execute(
+            f"SELECT 1 FROM products WHERE {base} AND id < ? LIMIT 1", (*params, rows[0][0])
+        ).fetchone() is not None
+    products = [{"id": r[0], "name": r[1], "price": r[2], "photo": r[3], "category": r[4]} for r in rows]
+    return products, has_prev, has_next
+
+async def db_products_page(flt, cursor=0, direction="n", limit=20):
+    return await db.run(_products_page, flt, cursor, direction, limit)
+
+# Фото кількох товарів однією транзакцією: {product_id: file_id}
+def _set_photos(conn, photos):
+    conn.executemany("UPDATE products SET photo=? WHERE id=?", [(photo, pid) for pid, photo in photos.items()])
+
+async def db_media_file_ids(digests):
+    if not digests:
+        return {}
+    rows = await db.fetchall(
+        f"SELECT sha256, file_id FROM media WHERE sha256 IN ({','.join('?' * len(digests))})", list(digests)
+    )
+    return dict(rows)
+
+async def db_save_media(digest, file_id, file_unique_id, path):
+    await db.execute(
+        "INSERT INTO media (sha256, file_id, file_unique_id, path, uploaded_at) VALUES (?,?,?,?,?) "
+        "ON CONFLICT(sha256) DO UPDATE SET file_id=excluded.file_id, file_unique_id=excluded.file_unique_id, "
+        "path=excluded.path, uploaded_at=excluded.uploaded_at",
+        (digest, file_id, file_unique_id, path, int(time.time()))
+    )
 
-# Зберегти замовлення
-def db_save_order(user_id, username, name, phone, address, items_text, total):
-    conn = get_db()
+# Масовий імпорт товарів: нові (name, price, desc, category) і оновлення
+# (name, price, desc, category, id). Фото при імпорті не чіпаємо.
+def _bulk_products(conn, inserts, updates):
+    conn.executemany("INSERT INTO products (name, price, desc, category) VALUES (?,?,?,?)", inserts)
+    conn.executemany("UPDATE products SET name=?, price=?, desc=?, category=? WHERE id=?", updates)
+
+# Експорт у CSV: курсори читаються порціями прямо у файл, без списку всіх рядків.
+# queries — [(sql, params)], виконуються по черзі без спільного сортування
+def _export_csv(conn, path, header, queries):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(header)
+        count = 0
+        for sql, params in queries:
+            cur = conn.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                csv_writer.writerows(rows)
+                count += len(rows)
+    return count
+
+async def db_export_products(path):
+    return await db.run(
+        _export_csv, path, ["id", "category", "name", "price", "desc"],
+        [("SELECT id, category, name, price, desc FROM products ORDER BY id", ())]
+    )
+
+# Замовлення за період: спершу архів (старіші), потім робоча таблиця. Кожна
+# частина йде по індексу created_at, тож рядки стрімляться без тимчасового сортування
+_EXPORT_ORDERS_SELECT = """
+    SELECT o.id, datetime(o.created_at, 'unixepoch', 'localtime'), o.user_id, o.username, o.name,
+           o.phone, o.address,
+           (SELECT group_concat(i.name || ' x' || i.qty, '; ') FROM {schema}.order_items i WHERE i.order_id = o.id),
+           o.total, o.status
+    FROM {schema}.orders o
+    WHERE o.created_at >= ? AND o.created_at < ?
+    ORDER BY o.created_at
+"""
+
+async def db_export_orders(path, date_from, date_to):
+    return await db.run(
+        _export_csv, path,
+        ["id", "date", "user_id", "username", "name", "phone", "address", "items", "total", "status"],
+        [(_EXPORT_ORDERS_SELECT.format(schema=schema), (date_from, date_to)) for schema in ("archive", "main")]
+    )
+
+# Зберегти замовлення. Ціни в кошику — знімок на момент додавання, тож перед
+# записом звіряємо їх з products одним запитом у тій самій транзакції запису
+# (письменник бере блокування одразу, тож адмін не змінить ціну між ними).
+# Якщо щось змінилось, нічого не пишемо і повертаємо (None, [(позиція, товар або None)]).
+def _save_order(conn, user_id, username, name, phone, address, cart, items_text, total):
     cur = conn.cursor()
-    date = datetime.now().strftime("%d.%m.%Y %H:%M")
+    ids = [item["id"] for item in cart]
+    current = {row[0]: {"id": row[0], "name": row[1], "price": row[2]} for row in cur.execute(
+        f"SELECT id, name, price FROM products WHERE id IN ({','.join('?' * len(ids))})", ids
+    )}
+    changes = [(item, current.get(item["id"])) for item in cart
+               if item["id"] not in current or current[item["id"]]["price"] != item["price"]]
+    if changes:
+        return None, changes
+    created_at = int(time.time())
     cur.execute(
-        "INSERT INTO orders (user_id, username, name, phone, address, items, total, date) VALUES (?,?,?,?,?,?,?,?)",
-        (user_id, username, name, phone, address, items_text, total, date)
+        "INSERT INTO orders (user_id, username, name, phone, address, items, total, created_at) VALUES (?,?,?,?,?,?,?,?)",
+        (user_id, username, name, phone, address, items_text, total, created_at)
     )
     order_id = cur.lastrowid
+    lines = [(item["id"], item["name"], item["qty"], item["price"]) for item in cart]
+    cur.executemany(
+        "INSERT INTO order_items (order_id, product_id, name, qty, price) VALUES (?,?,?,?,?)",
+        [(order_id, *line) for line in lines]
+    )
+    apply_rollups(conn, created_at, total, lines)
+
+    # Побічні дії пишемо в outbox тією ж транзакцією, що й замовлення
+    enqueue_job(conn, "user_counter", {"user_id": user_id, "username": username, "name": name})
+    enqueue_job(conn, "notify_admin", {
+        "order_id": order_id, "user_id": user_id, "name": name, "phone": phone,
+        "address": address, "items_text": items_text, "total": total,
+    })
+    return order_id, []
+
+# Додати задачу в outbox (всередині вже відкритої транзакції)
+def enqueue_job(conn, kind, payload):
+    conn.execute(
+        "INSERT INTO jobs (kind, payload, run_at) VALUES (?,?,?)",
+        (kind, json.dumps(payload, ensure_ascii=False), time.time())
+    )
 
-    # Оновлюємо лічильник замовлень користувача
-    cur.execute("""
-        INSERT INTO users (telegram_id, username, first_name, order_count)
-        VALUES (?, ?, ?, 1)
-        ON CONFLICT(telegram_id) DO UPDATE SET order_count = order_count + 1
-    """, (user_id, username, name))
+async def db_save_order(user_id, username, name, phone, address, cart, items_text, total):
+    return await writer.submit(_save_order, user_id, username, name, phone, address, cart, items_text, total)
+
+# Отримати замовлення користувача (старі можуть бути вже в архіві)
+async def db_get_user_orders(user_id):
+    return await db.fetchall(
+        "SELECT id, items, total, created_at, status, date FROM main.orders WHERE user_id=? "
+        "UNION ALL "
+        "SELECT id, items, total, created_at, status, date FROM archive.orders WHERE user_id=? "
+        "ORDER BY id DESC LIMIT 5",
+        (user_id, user_id)
+    )
 
-    conn.commit()
-    conn.close()
-    return order_id
+# Статуси замовлень по порядку; останній — кінцевий, такі замовлення зникають з дошки
+ORDER_STATUSES = ["Новий", "Прийнято", "Готується", "В дорозі", "Доставлено"]
+STATUS_ICONS = {"Новий": "🆕", "Прийнято": "✅", "Готується": "👨‍🍳", "В дорозі": "🛵", "Доставлено": "🏁"}
+ACTIVE_STATUSES = ORDER_STATUSES[:-1]
+
+# Статуси рухаються лише вперед; невідомий (старий) статус — найраніший
+def status_rank(status):
+    return ORDER_STATUSES.index(status) if status in ORDER_STATUSES else -1
+
+# Пачка змін статусів однією транзакцією. Клієнтам сповіщення йдуть через
+# outbox, тож вони не загубляться і не підуть, якщо транзакція відкотилась.
+# Застаріла кнопка не поверне замовлення назад: зміни, що не просувають статус, пропускаються.
+def _set_order_statuses(conn, changes):
+    marks = ",".join("?" * len(changes))
+    current = {order_id: (user_id, status) for order_id, user_id, status in conn.execute(
+        f"SELECT id, user_id, status FROM orders WHERE id IN ({marks})", [order_id for order_id, _ in changes]
+    )}
+    changed = [(status, order_id) for order_id, status in changes
+               if order_id in current and status_rank(status) > status_rank(current[order_id][1])]
+    conn.executemany("UPDATE orders SET status=? WHERE id=?", changed)
+    for status, order_id in changed:
+        enqueue_job(conn, "notify_status", {"order_id": order_id, "user_id": current[order_id][0], "status": status})
+    return len(changed)
+
+async def db_active_orders(limit):
+    marks = ",".join("?" * len(ACTIVE_STATUSES))
+    counts = dict(await db.fetchall(
+        f"SELECT status, COUNT(*) FROM orders WHERE status IN ({marks}) GROUP BY status", ACTIVE_STATUSES
+    ))
+    orders = await db.fetchall(
+        f"SELECT id, name, total, status, created_at FROM orders WHERE status IN ({marks}) ORDER BY id LIMIT ?",
+        (*ACTIVE_STATUSES, limit)
+    )
+    return counts, orders
+
+async def db_order_statuses(order_ids):
+    if not order_ids:
+        return {}
+    marks = ",".join("?" * len(order_ids))
+    return dict(await db.fetchall(f"SELECT id, status FROM orders WHERE id IN ({marks})", list(order_ids)))
+
+async def db_order_ids_with_status(status):
+    rows = await db.fetchall("SELECT id FROM orders WHERE status=? ORDER BY id", (status,))
+    return [row[0] for row in rows]
+
+async def db_get_setting(key):
+    row = await db.fetchone("SELECT value FROM settings WHERE key=?", (key,))
+    return row[0] if row else None
+
+# Спільна версія меню: кожен запис у products її збільшує, а воркери
+# порівнюють її зі своєю і перечитують меню, якщо хтось інший його змінив
+def _bump_menu_version(conn):
+    conn.execute(
+        "INSERT INTO settings (key, value) VALUES ('menu_version', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+    return conn.execute("SELECT value FROM settings WHERE key='menu_version'").fetchone()[0]
 
-# Отримати замовлення користувача
-def db_get_user_orders(user_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, items, total, date, status FROM orders WHERE user_id=? ORDER BY id DESC LIMIT 5",
-        (user_id,)
+async def db_set_setting(key, value):
+    await db.execute(
+        "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value)
+    )
+
+# Зведена статистика: оновлюється в транзакції кожного замовлення,
+# тож читання для адміна не залежить від розміру таблиці orders
+def apply_rollups(conn, created_at, total, lines):
+    dt = datetime.fromtimestamp(created_at)
+    conn.executemany(
+        "INSERT INTO stats_counters (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+        [("orders", 1), ("revenue", total)]
+    )
+    conn.execute(
+        "INSERT INTO stats_daily (day, orders, revenue) VALUES (?, 1, ?) "
+        "ON CONFLICT(day) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue",
+        (dt.strftime("%Y-%m-%d"), total)
+    )
+    conn.execute(
+        "INSERT INTO stats_hourly (hour, orders, revenue) VALUES (?, 1, ?) "
+        "ON CONFLICT(hour) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue",
+        (dt.strftime("%Y-%m-%d %H"), total)
+    )
+    conn.executemany(
+        "INSERT INTO stats_products (name, product_id, qty, revenue) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET qty = qty + excluded.qty, revenue = revenue + excluded.revenue, "
+        "product_id = COALESCE(excluded.product_id, product_id)",
+        [(name, product_id, qty, qty * price) for product_id, name, qty, price in lines]
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 # Статистика для адміна
-def db_get_stats():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*), SUM(total) FROM orders")
-    orders_row = cur.fetchone()
-    cur.execute("SELECT COUNT(*) FROM users")
-    users_count = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM products")
-    products_count = cur.fetchone()[0]
-    conn.close()
+def _get_stats(conn):
+    counters = dict(conn.execute("SELECT key, value FROM stats_counters").fetchall())
+    today = datetime.now()
+    yesterday = today - timedelta(days=1)
+    days = dict(
+        (r[0], (r[1], r[2])) for r in conn.execute(
+            "SELECT day, orders, revenue FROM stats_daily WHERE day IN (?, ?)",
+            (today.strftime("%Y-%m-%d"), yesterday.strftime("%Y-%m-%d"))
+        )
+    )
+    top = conn.execute("SELECT name, qty, revenue FROM stats_products ORDER BY qty DESC LIMIT 5").fetchall()
+    orders = counters.get("orders", 0)
+    revenue = counters.get("revenue", 0)
     return {
-        "orders": orders_row[0] or 0,
-        "revenue": orders_row[1] or 0,
-        "users": users_count,
-        "products": products_count
+        "orders": orders,
+        "revenue": revenue,
+        "users": counters.get("users", 0),
+        "avg_check": round(revenue / orders) if orders else 0,
+        "today": days.get(today.strftime("%Y-%m-%d"), (0, 0)),
+        "yesterday": days.get(yesterday.strftime("%Y-%m-%d"), (0, 0)),
+        "top": top,
     }
 
+async def db_get_stats():
+    stats = await db.run(_get_stats)
+    stats["products"] = menu.count()
+    return stats
+
+# ===== ПОШУК ПО МЕНЮ =====
+# Триграмний індекс по назві й опису. Кандидати — перетин множин id для
+# всіх триграм запиту, потім перевірка підрядком; назва важить більше за опис.
+class SearchIndex:
+    def __init__(self):
+        self._grams = {}
+        self._names = {}
+        self._texts = {}
+
+    @staticmethod
+    def _normalize(text):
+        return " ".join((text or "").lower().replace("’", "'").split())
+
+    @staticmethod
+    def _trigrams(text):
+        padded = f" {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, product):
+        name = self._normalize(product["name"])
+        text = f"{name} {self._normalize(product['desc'])}"
+        self._names[product["id"]] = name
+        self._texts[product["id"]] = text
+        for gram in self._trigrams(text):
+            self._grams.setdefault(gram, set()).add(product["id"])
+
+    def remove(self, product_id):
+        text = self._texts.pop(product_id, None)
+        self._names.pop(product_id, None)
+        if text is None:
+            return
+        for gram in self._trigrams(text):
+            ids = self._grams.get(gram)
+            if ids:
+                ids.discard(product_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def search(self, query, limit=10):
+        query = self._normalize(query)
+        if not query:
+            return []
+        if len(query) < 3:
+            candidates = self._texts.keys()
+        else:
+            # Триграми без пробілів по краях: запит може бути серединою слова
+            postings = [self._grams.get(query[i:i + 3], set()) for i in range(len(query) - 2)]
+            postings.sort(key=len)
+            candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+        found = []
+        for product_id in candidates:
+            name = self._names[product_id]
+            if query in name:
+                found.append((0 if name.startswith(query) else 1, product_id))
+            elif query in self._texts[product_id]:
+                found.append((2, product_id))
+        found.sort()
+        return [product_id for _, product_id in found[:limit]]
+
+# ===== КЕШ МЕНЮ =====
+# Меню змінюється кілька разів на день, тому тримаємо його в пам'яті:
+# індекси по id, по категорії і товари без фото. Адмінські зміни спочатку
+# пишуться в БД, а потім одразу оновлюють кеш (write-through).
+class MenuCatalog:
+    def __init__(self):
+        self.by_id = {}
+        self.by_cat = {}
+        self.no_photo = set()
+        self.version = 0
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.search_index = SearchIndex()
+        self.shared_version = None
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def load(self):
+        # Версію читаємо до товарів: зміна між цими запитами просто дасть ще одне перечитування
+        self.shared_version = await db_get_setting("menu_version")
+        rows = await db.fetchall("SELECT id, name, price, desc, photo, category FROM products ORDER BY id")
+        by_id, by_cat, no_photo, search_index = {}, {}, set(), SearchIndex()
+        for r in rows:
+            p = {"id": r[0], "name": r[1], "price": r[2], "desc": r[3], "photo": r[4], "category": r[5]}
+            by_id[p["id"]] = p
+            by_cat.setdefault(p["category"], []).append(p)
+            if not p["photo"]:
+                no_photo.add(p["id"])
+            search_index.add(p)
+        # Підміняємо всі індекси разом, щоб хендлери не бачили напівзавантажене меню
+        self.by_id, self.by_cat, self.no_photo, self.search_index = by_id, by_cat, no_photo, search_index
+        self.loaded = True
+        self.version += 1
+
+    def get(self, product_id):
+        product = self.by_id.get(product_id)
+        if product:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return product
+
+    def products(self, category):
+        if category in self.by_cat:
+            self.hits += 1
+            return self.by_cat[category]
+        self.misses += 1
+        return []
+
+    def without_photo(self):
+        self.hits += 1
+        return [self.by_id[i] for i in sorted(self.no_photo)]
+
+    def count(self):
+        return len(self.by_id)
+
+    def search(self, query, limit=10):
+        self.hits += 1
+        return [self.by_id[i] for i in self.search_index.search(query, limit)]
+
+    async def add(self, name, price, desc, photo, category):
+        async with self._lock:
+            product_id = await db_add_product(name, price, desc, photo, category)
+            await self._publish()
+            p = {"id": product_id, "name": name, "price": price, "desc": desc, "photo": photo, "category": category}
+            self.by_id[product_id] = p
+            self.by_cat.setdefault(category, []).append(p)
+            if not photo:
+                self.no_photo.add(product_id)
+            self.search_index.add(p)
+            self.version += 1
+            return product_id
+
+    async def delete(self, product_id):
+        async with self._lock:
+            await db_delete_product(product_id)
+            await self._publish()
+            p = self.by_id.pop(product_id, None)
+            if p:
+                self.by_cat[p["category"]] = [x for x in self.by_cat[p["category"]] if x["id"] != product_id]
+            self.no_photo.discard(product_id)
+            self.search_index.remove(product_id)
+            self.version += 1
+
+    async def set_photo(self, product_id, photo):
+        async with self._lock:
+            await db_update_photo(product_id, photo)
+            await self._publish()
+            p = self.by_id.get(product_id)
+            if p:
+                # Новий dict замість зміни на місці: старі посилання лишаються цілісними
+                p = dict(p, photo=photo)
+                self.by_id[product_id] = p
+                self.by_cat[p["category"]] = [p if x["id"] == product_id else x for x in self.by_cat[p["category"]]]
+            if photo:
+                self.no_photo.discard(product_id)
+            else:
+                self.no_photo.add(product_id)
+            self.version += 1
+
+    async def set_photos(self, photos):
+        """Фото багатьох товарів однією транзакцією, потім повне перезавантаження індексів."""
+        async with self._lock:
+            await db.run(_set_photos, photos)
+            await self._publish()
+            await self.load()
+
+    async def bulk_apply(self, inserts, updates):
+        """Масовий імпорт однією транзакцією, потім повне перезавантаження індексів."""
+        async with self._lock:
+            await db.run(_bulk_products, inserts, updates)
+            await self._publish()
+            await self.load()
+
+    async def _publish(self):
+        self.shared_version = await db.run(_bump_menu_version)
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await db_get_setting("menu_version") != self.shared_version:
+                    async with self._lock:
+                        await self.load()
+                    self.reloads += 1
+            except Exception as e:
+                print(f"⚠️ Не вдалося оновити меню: {e}")
+
+    def watch(self, interval=MENU_POLL_INTERVAL):
+        """Для кількох воркерів: перечитує меню, коли його змінив інший процес."""
+        if not self._task:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "products": len(self.by_id),
+            "version": self.version,
+            "reloads": self.reloads,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+menu = MenuCatalog()
+
+# ===== КОШИКИ =====
+# Де кошики лежать між процесами. SQLite — для одного хоста: кожен воркер при
+# старті читає лише кошики свого шарду. Redis — для кількох хостів: кошик
+# читається при першому зверненні, а застарілі ключі Redis видаляє сам (TTL).
+class SQLiteCartBackend:
+    lazy = False
+
+    async def load(self, cutoff):
+        await db.execute("DELETE FROM carts WHERE updated < ?", (cutoff,))
+        if WORKER_ID is None:
+            return await db.fetchall("SELECT user_id, items, updated FROM carts ORDER BY updated")
+        return await db.fetchall(
+            "SELECT user_id, items, updated FROM carts WHERE user_id % ? = ? ORDER BY updated",
+            (WORKERS, WORKER_ID)
+        )
+
+    async def get(self, user_id):
+        return await db.fetchone("SELECT items, updated FROM carts WHERE user_id=?", (user_id,))
+
+    async def save(self, upserts, deletes, cutoff):
+        def flush_carts(conn):
+            conn.executemany(
+                "INSERT INTO carts (user_id, items, updated) VALUES (?,?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET items=excluded.items, updated=excluded.updated",
+                upserts
+            )
+            conn.executemany("DELETE FROM carts WHERE user_id=?", deletes)
+            # Покинуті кошики, які лежать тільки на диску
+            expired = [r[0] for r in conn.execute("SELECT user_id FROM carts WHERE updated < ?", (cutoff,))]
+            conn.execute("DELETE FROM carts WHERE updated < ?", (cutoff,))
+            return expired
+
+        return await db.run(flush_carts)
+
+    async def close(self):
+        pass
+
+class RedisCartBackend:
+    lazy = True
+
+    def __init__(self, url, ttl):
+        # Потрібен пакет redis: pip install redis
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+        self.ttl = ttl
+
+    async def load(self, cutoff):
+        return []
+
+    async def get(self, user_id):
+        raw = await self.redis.get(f"cart:{user_id}")
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        return value["items"], value["updated"]
+
+    async def save(self, upserts, deletes, cutoff):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, items, updated in upserts:
+                pipe.set(f"cart:{user_id}", json.dumps({"items": items, "updated": updated}), ex=self.ttl)
+            for (user_id,) in deletes:
+                pipe.delete(f"cart:{user_id}")
+            await pipe.execute()
+        return []
+
+    async def close(self):
+        await self.redis.aclose()
+
+def make_cart_backend():
+    if CART_STORAGE == "redis":
+        return RedisCartBackend(REDIS_URL or "redis://localhost:6379/0", CART_TTL)
+    return SQLiteCartBackend()
+
+class Cart:
+    __slots__ = ("items", "updated")
+
+    def __init__(self, items=None, updated=0.0):
+        # product_id -> [qty, price, name]
+        self.items = items or {}
+        self.updated = updated
+
+# Кошики в пам'яті з обмеженим розміром: порожні кошики одразу видаляються,
+# покинуті — після CART_TTL, а понад CART_MAX найстаріші витісняються на диск.
+# Зміни пачками скидаються в таблицю carts, тож рестарт їх не губить.
+class CartStore:
+    def __init__(self, backend, ttl=CART_TTL, max_size=CART_MAX, flush_interval=CART_FLUSH_INTERVAL):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._carts = OrderedDict()
+        self._dirty = set()
+        self._pending = {}
+        self._spilled = set()
+        self._task = None
+        self.evicted = 0
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._carts)
+
+    async def load(self):
+        rows = await self.backend.load(time.time() - self.ttl)
+        for user_id, items, updated in rows:
+            if len(self._carts) >= self.max_size:
+                self._spilled.add(user_id)
+                continue
+            self._carts[user_id] = Cart({pid: [qty, price, name] for pid, qty, price, name in json.loads(items)}, updated)
+
+    async def _get(self, user_id, create=False):
+        cart = self._carts.get(user_id) or self._pending.pop(user_id, None)
+        if cart is None and (user_id in self._spilled or self.backend.lazy):
+            row = await self.backend.get(user_id)
+            if row:
+                cart = Cart({pid: [qty, price, name] for pid, qty, price, name in json.loads(row[0])}, row[1])
+        self._spilled.discard(user_id)
+        if cart is None and create:
+            cart = Cart()
+        if cart is not None:
+            cart.updated = time.time()
+            self._carts[user_id] = cart
+            self._carts.move_to_end(user_id)
+            self._evict()
+        return cart
+
+    def _evict(self):
+        now = time.time()
+        while self._carts:
+            user_id, cart = next(iter(self._carts.items()))
+            if len(self._carts) > self.max_size:
+                # Кошик ще живий: тримаємо до найближчого flush, потім читаємо з диска
+                self._pending[user_id] = cart
+                self._spilled.add(user_id)
+            elif now - cart.updated <= self.ttl:
+                break
+            self._carts.popitem(last=False)
+            self._dirty.add(user_id)
+            self.evicted += 1
+
+    async def items(self, user_id):
+        cart = await self._get(user_id)
+        if not cart:
+            return []
+        return [{"id": pid, "name": name, "price": price, "qty": qty} for pid, (qty, price, name) in cart.items.items()]
+
+    async def is_empty(self, user_id):
+        cart = await self._get(user_id)
+        return not cart or not cart.items
+
+    async def add(self, user_id, product):
+        cart = await self._get(user_id, create=True)
+        line = cart.items.get(product["id"])
+        if line:
+            line[0] += 1
+        else:
+            line = cart.items[product["id"]] = [1, product["price"], product["name"]]
+        self._dirty.add(user_id)
+        return line[0]
+
+    async def reprice(self, user_id, products):
+        """Оновлює позиції за актуальним меню: products — id -> товар, або None, якщо його вже немає."""
+        cart = await self._get(user_id)
+        if not cart:
+            return
+        for product_id, product in products.items():
+            if product is None:
+                cart.items.pop(product_id, None)
+            elif product_id in cart.items:
+                cart.items[product_id][1:] = [product["price"], product["name"]]
+        self._dirty.add(user_id)
+
+    async def clear(self, user_id):
+        self._carts.pop(user_id, None)
+        self._pending.pop(user_id, None)
+        self._spilled.discard(user_id)
+        self._dirty.add(user_id)
+
+    async def flush(self):
+        if not self._dirty and not self._spilled:
+            return
+        dirty, self._dirty = self._dirty, set()
+        cutoff = time.time() - self.ttl
+        upserts, deletes = [], []
+        for user_id in dirty:
+            cart = self._carts.get(user_id) or self._pending.get(user_id)
+            if cart and cart.items:
+                payload = json.dumps([[pid, qty, price, name] for pid, (qty, price, name) in cart.items.items()], ensure_ascii=False)
+                upserts.append((user_id, payload, cart.updated))
+            else:
+                deletes.append((user_id,))
+        try:
+            expired = await self.backend.save(upserts, deletes, cutoff)
+        except Exception:
+            # Не вийшло — спробуємо наступного разу
+            self._dirty |= dirty
+            raise
+        self._spilled.difference_update(expired)
+        for user_id in dirty:
+            self._pending.pop(user_id, None)
+        self.flushes += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._evict()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Не вдалося зберегти кошики: {e}")
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self.backend.close()
+
+    def stats(self):
+        return {
+            "active": len(self._carts),
+            "spilled": len(self._spilled),
+            "dirty": len(self._dirty),
+            "evicted": self.evicted,
+            "flushes": self.flushes,
+        }
+
+carts = CartStore(make_cart_backend())
+
+# ===== ЧЕРГА ЗАДАЧ =====
+# Надійна черга поверх таблиці jobs. Воркери забирають задачі, у яких настав
+# run_at, і видаляють їх після успіху. Помилка — повтор з експоненційною
+# затримкою, після JOB_MAX_ATTEMPTS задача лишається в статусі 'failed'.
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS, poll_interval=1.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._claimed = set()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    def handler(self, kind):
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _claim(self):
+        rows = await db.fetchall(
+            "SELECT id, kind, payload, attempts FROM jobs WHERE status='pending' AND run_at <= ? ORDER BY id LIMIT 20",
+            (time.time(),)
+        )
+        for row in rows:
+            if row[0] not in self._claimed:
+                self._claimed.add(row[0])
+                return row
+        return None
+
+    async def _run(self, job_id, kind, payload, attempts):
+        try:
+            await self._handlers[kind](json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                await db.execute(
+                    "UPDATE jobs SET status='failed', attempts=?, last_error=? WHERE id=?",
+                    (attempts, repr(e), job_id)
+                )
+                print(f"⚠️ Задача {kind} #{job_id} не виконана: {e}")
+            else:
+                self.retried += 1
+                await db.execute(
+                    "UPDATE jobs SET attempts=?, run_at=?, last_error=? WHERE id=?",
+                    (attempts, time.time() + min(2 ** attempts, 300), repr(e), job_id)
+                )
+        else:
+            self.done += 1
+            await db.execute("DELETE FROM jobs WHERE id=?", (job_id,))
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"⚠️ Черга задач: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(*job)
+            except Exception as e:
+                print(f"⚠️ Черга задач: {e}")
+            finally:
+                self._claimed.discard(job[0])
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def stats(self):
+        pending = await db.fetchone("SELECT COUNT(*) FROM jobs WHERE status='pending'")
+        failed = await db.fetchone("SELECT COUNT(*) FROM jobs WHERE status='failed'")
+        return {"pending": pending[0], "failed": failed[0], "done": self.done, "retried": self.retried}
+
+jobs = JobQueue()
+
+# ===== СХОВИЩЕ FSM =====
+# Стани і дані FSM у SQLite з LRU-кешем у пам'яті. Записи потрапляють у кеш
+# одразу, а в БД — пачкою раз на FSM_FLUSH_INTERVAL. Застарілі стани (FSM_TTL)
+# видаляються. Для кількох воркерів замість нього підключається RedisStorage.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, cache_size=FSM_CACHE_SIZE, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # key -> [state, data, updated]
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._dirty = set()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self._ticks = 0
+
+    async def _entry(self, key):
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            entry = self._pending.get(k)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = await db.fetchone("SELECT state, data, updated FROM fsm WHERE key=?", (k,))
+            entry = [row[0], json.loads(row[1]), row[2]] if row else [None, {}, 0.0]
+            # Поки йшов запит, запис могли вже створити
+            entry = self._cache.get(k) or entry
+        if entry[2] and time.time() - entry[2] > self.ttl:
+            entry = [None, {}, 0.0]
+            self._dirty.add(k)
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        self._evict()
+        return k, entry
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            k, entry = self._cache.popitem(last=False)
+            if k in self._dirty:
+                self._pending[k] = entry
+
+    async def set_state(self, key, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        entry[2] = time.time()
+        self._dirty.add(k)
+
+    async def get_state(self, key):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key, data):
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        entry[2] = time.time()
+        self._dirty.add(k)
+
+    async def get_data(self, key):
+        _, entry = await self._entry(key)
+        return dict(entry[1])
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in dirty:
+            entry = self._cache.get(k) or self._pending.get(k)
+            if entry and (entry[0] or entry[1]):
+                upserts.append((k, entry[0], json.dumps(entry[1], ensure_ascii=False), entry[2]))
+            else:
+                deletes.append((k,))
+        cutoff = time.time() - self.ttl
+
+        def flush_fsm(conn):
+            conn.executemany(
+                "INSERT INTO fsm (key, state, data, updated) VALUES (?,?,?,?) "
+                "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated=excluded.updated",
+                upserts
+            )
+            conn.executemany("DELETE FROM fsm WHERE key=?", deletes)
+            conn.execute("DELETE FROM fsm WHERE updated < ?", (cutoff,))
+
+        self._ticks += 1
+        if not dirty and self._ticks % 60:
+            # Без змін чистимо застарілі стани лише раз на 60 циклів
+            return
+        try:
+            await db.run(flush_fsm)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        for k in dirty:
+            self._pending.pop(k, None)
+        self.flushes += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Не вдалося зберегти стани FSM: {e}")
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._dirty:
+            await self.flush()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+def make_storage():
+    if FSM_STORAGE == "redis":
+        # Потрібен пакет redis: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            REDIS_URL or "redis://localhost:6379/0",
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=FSM_TTL,
+            data_ttl=FSM_TTL,
+        )
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage()
+
+# ===== ВИХІДНІ ПОВІДОМЛЕННЯ =====
+# Усі запити до Bot API проходять через middleware сесії: перед відправкою
+# чекаємо токен з корзини чату і з загальної корзини (з пріоритетом —
+# відповіді клієнтам раніше за сповіщення адміну, а масові розсилки — останніми),
+# а на 429 чекаємо retry_after. Корзина чату — лише для нових повідомлень:
+# редагування, видалення і закріплення під ліміт «повідомлень на чат» не потрапляють.
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+send_priority = ContextVar("send_priority", default=PRIORITY_USER)
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self):
+        """Забирає токен (можна в борг) і повертає, скільки секунд треба почекати."""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def take(self):
+        """Забирає токен, якщо він є; в борг не бере."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+MESSAGE_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+
+def creates_message(method):
+    name = method.__api_method__
+    return name in MESSAGE_METHODS or (name.startswith("send") and name != "sendChatAction")
+
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 max_retries=SEND_MAX_RETRIES, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._waiters = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.waiting_chat = 0
+        self.sent = {PRIORITY_USER: 0, PRIORITY_ADMIN: 0, PRIORITY_BULK: 0}
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            # Забуваємо корзини чатів, які давно нічого не отримували
+            while len(self._chats) > self.max_chats:
+                old_id, old = next(iter(self._chats.items()))
+                if not old.idle():
+                    break
+                del self._chats[old_id]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _grant_loop(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.global_bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            while self._waiters:
+                _, _, fut = heapq.heappop(self._waiters)
+                if not fut.done():
+                    fut.set_result(None)
+                    break
+
+    async def _global_permit(self, priority):
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._grant_loop())
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        self._wakeup.set()
+        await fut
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await self._request(make_request, bot, method)
+        priority = send_priority.get()
+        started = time.monotonic()
+        limited = creates_message(method)
+        for attempt in range(self.max_retries + 1):
+            bucket = self._chat_bucket(chat_id) if limited else None
+            delay = bucket.reserve() if bucket else 0
+            if delay:
+                self.waiting_chat += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.waiting_chat -= 1
+            await self._global_permit(priority)
+            try:
+                result = await self._request(make_request, bot, method)
+                break
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                if bucket:
+                    bucket.pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+        latency = time.monotonic() - started
+        self.sent[priority] += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        return result
+
+    @staticmethod
+    async def _request(make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", [("method", name), ("error", type(e).__name__)])
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", [("method", name)], time.perf_counter() - started)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        sent = sum(self.sent.values())
+        return {
+            "queue_depth": len(self._waiters) + self.waiting_chat,
+            "sent_user": self.sent[PRIORITY_USER],
+            "sent_admin": self.sent[PRIORITY_ADMIN],
+            "sent_bulk": self.sent[PRIORITY_BULK],
+            "retries": self.retries,
+            "latency_avg_ms": round(self.latency_total / sent * 1000, 3) if sent else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+        }
+
+# aiogram серіалізує метод цілком (model_dump усього SendMessage), тож
+# вкладена клавіатура щоразу дампиться заново. Готові клавіатури (PrebuiltMarkup)
+# підставляємо у форму вже як JSON-рядок, зібраний один раз.
+class PrebuiltSession(AiohttpSession):
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if not isinstance(markup, PrebuiltMarkup):
+            return super().build_form_data(bot, method)
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        form.add_field("reply_markup", markup.prepared(self, bot))
+        return form
+
+def make_session():
+    # BOT_API_URL дозволяє направити бота на локальний (тестовий) Bot API сервер
+    if BOT_API_URL:
+        return PrebuiltSession(api=TelegramAPIServer.from_base(BOT_API_URL))
+    return PrebuiltSession()
+
+async def notify_admin(text, **kwargs):
+    token = send_priority.set(PRIORITY_ADMIN)
+    try:
+        return await bot.send_message(ADMIN_ID, text, **kwargs)
+    finally:
+        send_priority.reset(token)
+
+outbox = SendScheduler()
+bot = Bot(token=TOKEN, session=make_session())
+bot.session.middleware(outbox)
+storage = make_storage()
+dp = Dispatcher(storage=storage)
+
+# ===== ІНСТРУМЕНТАЦІЯ =====
+# Зовнішній middleware міряє весь апдейт (і за бажанням профілює його),
+# внутрішній — саме хендлер, з його назвою в мітці.
+class UpdateTiming(BaseMiddleware):
+    def __init__(self, sample=PROFILE_SAMPLE, slow_ms=PROFILE_SLOW_MS, profile_dir=PROFILE_DIR):
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.profile_dir = profile_dir
+        self._profiling = False
+
+    async def __call__(self, handler, event, data):
+        profiler = None
+        # cProfile бачить увесь потік, тому одночасно профілюємо лише один апдейт
+        if self.sample and not self._profiling and random.random() < self.sample:
+            self._profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.inc("bot_updates_total", [("type", event.event_type)])
+            metrics.observe("bot_update_seconds", [("type", event.event_type)], elapsed)
+            if profiler:
+                profiler.disable()
+                self._profiling = False
+                if elapsed * 1000 >= self.slow_ms:
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    path = os.path.join(self.profile_dir, f"update-{event.update_id}-{int(elapsed * 1000)}ms.prof")
+                    profiler.dump_stats(path)
+                    print(f"🐢 Повільний апдейт {event.update_id}: {elapsed * 1000:.0f} мс, профіль {path}")
+
+class HandlerTiming(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        route = data.get("route")
+        name = route.name if route else data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", [("handler", name), ("error", type(e).__name__)])
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", [("handler", name)], time.perf_counter() - started)
+
+dp.update.outer_middleware(UpdateTiming())
+dp.message.middleware(HandlerTiming())
+dp.callback_query.middleware(HandlerTiming())
+dp.inline_query.middleware(HandlerTiming())
+
+def fsm_sessions():
+    if isinstance(storage, SQLiteStorage):
+        return storage.stats()["cached"]
+    return len(getattr(storage, "storage", ()))
+
+metrics.gauge("bot_active_carts", lambda: len(carts))
+metrics.gauge("bot_fsm_sessions", fsm_sessions)
+metrics.gauge("bot_send_queue_depth", lambda: outbox.stats()["queue_depth"])
+metrics.gauge("bot_db_pool_idle", lambda: db.stats()["idle"])
+metrics.gauge("bot_db_pool_waiting", lambda: db.stats()["waiting"])
+metrics.gauge("bot_group_commit_writes_total", lambda: writer.writes, "counter")
+metrics.gauge("bot_group_commit_batches_total", lambda: writer.batches, "counter")
+metrics.gauge("bot_menu_cache_hits_total", lambda: menu.hits, "counter")
+metrics.gauge("bot_menu_cache_misses_total", lambda: menu.misses, "counter")
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+# ===== МАРШРУТИЗАЦІЯ =====
+# Замість перебору фільтрів усіх хендлерів по черзі — хеш-індекси: команда,
+# (стан, текст кнопки), стан і префікс callback_data. На апдейт — кілька
+# звернень до dict незалежно від кількості хендлерів. Якщо підходять кілька
+# маршрутів (кнопка і стан), виграє той, що зареєстрований раніше, як і в aiogram.
+class CategoryCallback(CallbackData, prefix="cat"):
+    category: str
+
+class ProductCallback(CallbackData, prefix="product"):
+    id: int
+
+class AddCallback(CallbackData, prefix="add"):
+    id: int
+
+class AdminCategoryCallback(CallbackData, prefix="admin_cat"):
+    category: str
+
+class PageCallback(CallbackData, prefix="pl"):
+    mode: str
+    flt: str
+    dir: str
+    cursor: int
+
+class ExportOrdersCallback(CallbackData, prefix="export_orders"):
+    days: int
+
+class StatusCallback(CallbackData, prefix="os"):
+    order_id: int
+    status: int
+
+class BoardCallback(CallbackData, prefix="ob"):
+    action: str
+
+class GalleryCallback(CallbackData, prefix="gallery"):
+    category: str
+
+# Кнопки, надіслані до переходу на CallbackData (cat_pizza, add_5), теж працюють
+LEGACY_CALLBACK_RE = re.compile(r"^(admin_cat|cat|product|add|export_orders)_(.+)$")
+
+class Route:
+    __slots__ = ("seq", "name", "handler", "when", "factory", "state", "throttle")
+
+    def __init__(self, seq, fn, when=None, factory=None, state=None, throttle="default"):
+        self.seq = seq
+        self.name = fn.__name__
+        self.handler = CallableObject(fn)
+        self.when = when
+        self.factory = factory
+        self.state = state
+        self.throttle = throttle
+
+class Routes(BaseMiddleware):
+    def __init__(self):
+        self.commands = {}
+        self.texts = {}
+        self.states = {}
+        self.callbacks = {}
+        self._seq = 0
+        self.routed = 0
+        self.unrouted = 0
+
+    def size(self):
+        return len(self.commands) + len(self.texts) + sum(map(len, self.states.values())) + len(self.callbacks)
+
+    def _add(self, register, **kwargs):
+        def decorator(fn):
+            self._seq += 1
+            register(Route(self._seq, fn, **kwargs))
+            return fn
+        return decorator
+
+    def command(self, name):
+        return self._add(lambda route: self.commands.setdefault(name, route))
+
+    def text(self, text, state=None, throttle="default"):
+        """Точний текст кнопки; без state — у будь-якому стані."""
+        key = (state.state if state else None, text)
+        return self._add(lambda route: self.texts.setdefault(key, route), throttle=throttle)
+
+    def state(self, state, when=None):
+        """Будь-яке повідомлення в стані; when — додатковий MagicFilter (F.photo)."""
+        return self._add(lambda route: self.states.setdefault(state.state, []).append(route), when=when)
+
+    def callback(self, key, state=None, throttle="default"):
+        """key — клас CallbackData або точний рядок callback_data; throttle — клас ліміту."""
+        if isinstance(key, str):
+            prefix, factory = key, None
+        else:
+            prefix, factory = key.__prefix__, key
+        return self._add(lambda route: self.callbacks.setdefault(prefix, route),
+                         factory=factory, state=state.state if state else None, throttle=throttle)
+
+    def _resolve_message(self, message, raw_state):
+        candidates = []
+        text = message.text
+        if text:
+            if text.startswith("/"):
+                name, _, args = text[1:].partition(" ")
+                name, _, mention = name.partition("@")
+                route = self.commands.get(name)
+                if route:
+                    candidates.append((route, {"command": CommandObject(
+                        prefix="/", command=name, mention=mention or None, args=args.strip() or None
+                    )}))
+            route = self.texts.get((raw_state, text)) or self.texts.get((None, text))
+            if route:
+                candidates.append((route, {}))
+        for route in self.states.get(raw_state, ()):
+            if route.when is None or route.when.resolve(message):
+                candidates.append((route, {}))
+                break
+        if not candidates:
+            return None, {}
+        return min(candidates, key=lambda c: c[0].seq)
+
+    def _resolve_callback(self, callback, raw_state):
+        data = callback.data or ""
+        prefix, sep, _ = data.partition(":")
+        route = self.callbacks.get(prefix)
+        if route is None and not sep:
+            legacy = LEGACY_CALLBACK_RE.match(data)
+            if legacy:
+                prefix, data = legacy[1], f"{legacy[1]}:{legacy[2]}"
+                route = self.callbacks.get(prefix)
+        if route is None or (route.state and route.state != raw_state):
+            return None, {}
+        if route.factory is None:
+            return route, {}
+        try:
+            return route, {"callback_data": route.factory.unpack(data)}
+        except (TypeError, ValueError):
+            return None, {}
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, types.CallbackQuery):
+            route, extra = self._resolve_callback(event, data.get("raw_state"))
+        else:
+            route, extra = self._resolve_message(event, data.get("raw_state"))
+        if route:
+            self.routed += 1
+            data["route"] = route
+            data.update(extra)
+        else:
+            self.unrouted += 1
+        return await handler(event, data)
+
+routes = Routes()
+dp.message.outer_middleware(routes)
+dp.callback_query.outer_middleware(routes)
+
+def routed(event, route=None):
+    return route is not None
+
+# Єдиний зареєстрований в aiogram хендлер для індексованих маршрутів; решта
+# (inline-режим, пошук текстом) лишаються звичайними хендлерами після нього
+@dp.message(routed)
+@dp.callback_query(routed)
+async def dispatch_route(event, route, **data):
+    return await route.handler.call(event, **data)
+
+# ===== АНТИФЛУД =====
+# Після маршрутизації, до хендлера: повторне натискання тієї ж кнопки в межах
+# вікна відкидається, а кожен клієнт має корзину токенів на клас хендлерів.
+# Відкинутий callback одразу отримує answer — без БД і клавіатур. Стан —
+# у LRU з обмеженим розміром; адмін не обмежується.
+THROTTLE_LIMITS = {
+    # клас: (токенів за секунду, запас)
+    "cart": (1, 4),
+    "browse": (2, 8),
+    "default": (1, 6),
+}
+
+class Throttle(BaseMiddleware):
+    def __init__(self, limits=THROTTLE_LIMITS, window=THROTTLE_DEDUP_WINDOW, max_users=THROTTLE_MAX_USERS):
+        self.limits = limits
+        self.window = window
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+        self._taps = OrderedDict()
+        self.limited = 0
+        self.duplicates = 0
+
+    def _bucket(self, user_id, kind):
+        key = (user_id, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.limits[kind])
+            while len(self._buckets) > self.max_users:
+                old_key, old = next(iter(self._buckets.items()))
+                if not old.idle():
+                    break
+                del self._buckets[old_key]
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _duplicate(self, callback):
+        now = time.monotonic()
+        while self._taps:
+            key, stamp = next(iter(self._taps.items()))
+            if now - stamp < self.window and len(self._taps) <= self.max_users:
+                break
+            del self._taps[key]
+        message = callback.message
+        key = (callback.from_user.id, callback.data, message.message_id if message else callback.inline_message_id)
+        if key in self._taps:
+            return True
+        self._taps[key] = now
+        return False
+
+    def stats(self):
+        return {"limited": self.limited, "duplicates": self.duplicates, "users": len(self._buckets)}
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        callback = isinstance(event, types.CallbackQuery)
+        route = data.get("route")
+        kind = route.throttle if route else "default"
+        if callback and self._duplicate(event):
+            self.duplicates += 1
+            metrics.inc("bot_throttled_total", [("reason", "duplicate"), ("class", kind)])
+            await event.answer()
+            return None
+        if not self._bucket(user.id, kind).take():
+            self.limited += 1
+            metrics.inc("bot_throttled_total", [("reason", "limit"), ("class", kind)])
+            if callback:
+                await event.answer("⏳ Не так швидко")
+            return None
+        return await handler(event, data)
+
+throttle = Throttle()
+if THROTTLE:
+    dp.message.outer_middleware(throttle)
+    dp.callback_query.outer_middleware(throttle)
+metrics.describe("bot_throttled_total", "Відкинуті антифлудом апдейти")
+metrics.gauge("bot_throttle_users", lambda: throttle.stats()["users"])
+
 # ===== СТАНИ =====
 class OrderForm(StatesGroup):
     name = State()
     phone = State()
     address = State()
+    confirm = State()
 
 class AdminAdd(StatesGroup):
     category = State()
@@ -210,6 +2251,9 @@ class AdminPhoto(StatesGroup):
     product_id = State()
     photo = State()
 
+class AdminImport(StatesGroup):
+    file = State()
+
 # ===== КЛАВІАТУРИ =====
 main_menu = ReplyKeyboardMarkup(
     keyboard=[
@@ -224,7 +2268,9 @@ admin_menu = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="➕ Додати товар"), KeyboardButton(text="🗑 Видалити товар")],
         [KeyboardButton(text="📸 Додати фото"), KeyboardButton(text="📋 Всі товари")],
-        [KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="📥 Імпорт меню"), KeyboardButton(text="📤 Експорт")],
+        [KeyboardButton(text="🖼 Фото з папки")],
+        [KeyboardButton(text="🗂 Замовлення"), KeyboardButton(text="📊 Статистика")],
         [KeyboardButton(text="◀️ Вийти з адмін панелі")]
     ],
     resize_keyboard=True
@@ -243,47 +2289,265 @@ skip_keyboard = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-def catalog_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🍕 Піца", callback_data="cat_pizza")],
-        [InlineKeyboardButton(text="🥤 Напої", callback_data="cat_drinks")],
-        [InlineKeyboardButton(text="🍰 Десерти", callback_data="cat_desserts")],
+# Клавіатура, яка серіалізується один раз: PrebuiltSession бере з неї готовий
+# JSON замість дампу при кожній відправці.
+class PrebuiltMarkup(InlineKeyboardMarkup):
+    _json: str = PrivateAttr(default=None)
+
+    def prepared(self, session, bot):
+        if self._json is None:
+            self._json = session.prepare_value(self.model_dump(warnings=False), bot=bot, files={})
+        return self._json
+
+# Кеш готових клавіатур і карток товарів. Прив'язаний до версії меню:
+# як тільки адмін змінює каталог, все перебудовується при наступному зверненні.
+class RenderCache:
+    def __init__(self):
+        self._items = {}
+        self.version = None
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, key, build, *args):
+        if self.version != menu.version:
+            self._items.clear()
+            self.version = menu.version
+        item = self._items.get(key)
+        if item is None:
+            item = self._items[key] = build(*args)
+            self.builds += 1
+        else:
+            self.hits += 1
+        return item
+
+    def stats(self):
+        return {"items": len(self._items), "version": self.version, "hits": self.hits, "builds": self.builds}
+
+renders = RenderCache()
+
+def _build_catalog_keyboard():
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🍕 Піца", callback_data=CategoryCallback(category="pizza").pack())],
+        [InlineKeyboardButton(text="🥤 Напої", callback_data=CategoryCallback(category="drinks").pack())],
+        [InlineKeyboardButton(text="🍰 Десерти", callback_data=CategoryCallback(category="desserts").pack())],
     ])
 
-def products_keyboard(category):
-    products = db_get_products(category)
+def catalog_keyboard():
+    return renders.get("catalog", _build_catalog_keyboard)
+
+def _build_products_keyboard(category):
+    products = menu.products(category)
     buttons = []
     for p in products:
         buttons.append([InlineKeyboardButton(
             text=f"{p['name']} — {p['price']} грн",
-            callback_data=f"product_{p['id']}"
+            callback_data=ProductCallback(id=p["id"]).pack()
+        )])
+    if any(p["photo"] for p in products):
+        buttons.append([InlineKeyboardButton(
+            text="🖼 Галерея", callback_data=GalleryCallback(category=category).pack()
         )])
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="back_catalog")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return PrebuiltMarkup(inline_keyboard=buttons)
 
-def add_to_cart_keyboard(product_id):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛒 Додати в кошик", callback_data=f"add_{product_id}")],
+def products_keyboard(category):
+    return renders.get(("products", category), _build_products_keyboard, category)
+
+# Галерея категорії: альбоми по 10 фото (ліміт sendMediaGroup) з назвою і ціною в підписі
+def _build_gallery(category):
+    media = [
+        InputMediaPhoto(media=p["photo"], caption=f"{p['name']} — {p['price']} грн")
+        for p in menu.products(category) if p["photo"]
+    ]
+    return [media[i:i + 10] for i in range(0, len(media), 10)]
+
+def category_gallery(category):
+    return renders.get(("gallery", category), _build_gallery, category)
+
+def _build_add_to_cart_keyboard(product_id):
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🛒 Додати в кошик", callback_data=AddCallback(id=product_id).pack())],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="back_catalog")]
     ])
 
-def cart_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
+def add_to_cart_keyboard(product_id):
+    return renders.get(("add", product_id), _build_add_to_cart_keyboard, product_id)
+
+def _build_cart_keyboard():
+    return PrebuiltMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Оформити замовлення", callback_data="checkout")],
         [InlineKeyboardButton(text="🗑 Очистити кошик", callback_data="clear_cart")],
         [InlineKeyboardButton(text="🛍 Продовжити покупки", callback_data="continue_shopping")]
     ])
 
+def cart_keyboard():
+    return renders.get("cart", _build_cart_keyboard)
+
+def _build_admin_category_keyboard():
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🍕 Піца", callback_data=AdminCategoryCallback(category="pizza").pack())],
+        [InlineKeyboardButton(text="🥤 Напої", callback_data=AdminCategoryCallback(category="drinks").pack())],
+        [InlineKeyboardButton(text="🍰 Десерти", callback_data=AdminCategoryCallback(category="desserts").pack())],
+    ])
+
 def admin_category_keyboard():
+    return renders.get("admin_cat", _build_admin_category_keyboard)
+
+# Для повідомлень з inline-режиму: там немає "Назад", бо немає куди повертатись
+def _build_inline_product_keyboard(product_id):
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🛒 Додати в кошик", callback_data=AddCallback(id=product_id).pack())]
+    ])
+
+def inline_product_keyboard(product_id):
+    return renders.get(("inline_add", product_id), _build_inline_product_keyboard, product_id)
+
+def search_keyboard(products):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🍕 Піца", callback_data="admin_cat_pizza")],
-        [InlineKeyboardButton(text="🥤 Напої", callback_data="admin_cat_drinks")],
-        [InlineKeyboardButton(text="🍰 Десерти", callback_data="admin_cat_desserts")],
+        [InlineKeyboardButton(text=f"🛒 {p['name']} — {p['price']} грн", callback_data=AddCallback(id=p["id"]).pack())]
+        for p in products
     ])
 
+# ===== СТОРІНКИ ТОВАРІВ =====
+CATEGORY_NAMES = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
+PAGE_SIZE = 20
+PAGE_TITLES = {
+    "list": "📋 *Всі товари*",
+    "photo": "📸 *Додати фото*",
+    "delete": "🗑 *Видалити товар*",
+}
+PAGE_FILTERS = [("all", "Всі"), ("pizza", "🍕"), ("drinks", "🥤"), ("desserts", "🍰"), ("nophoto", "🚫 фото")]
+
+async def product_page(mode, flt, cursor=0, direction="n"):
+    products, has_prev, has_next = await db_products_page(flt, cursor, direction, PAGE_SIZE)
+    title = PAGE_TITLES[mode]
+    if flt == "nophoto":
+        title += " — без фото"
+    elif flt in CATEGORY_NAMES:
+        title += f" — {CATEGORY_NAMES[flt]}"
+    text = f"{title}\n\n"
+    for p in products:
+        icon = CATEGORY_NAMES.get(p["category"], "")[:1]
+        if mode == "list":
+            photo_status = "📸" if p["photo"] else "🚫"
+            text += f"{icon} {photo_status} ID:{p['id']} | {p['name']} — {p['price']} грн\n"
+        else:
+            text += f"{icon} ID:{p['id']} | {p['name']}\n"
+    if not products:
+        text += "Нічого немає.\n"
+
+    filters = [
+        InlineKeyboardButton(text=f"• {label}" if key == flt else label, callback_data=PageCallback(mode=mode, flt=key, dir="n", cursor=0).pack())
+        for key, label in PAGE_FILTERS
+    ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=PageCallback(mode=mode, flt=flt, dir="p", cursor=products[0]["id"]).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=PageCallback(mode=mode, flt=flt, dir="n", cursor=products[-1]["id"]).pack()))
+    rows = [filters] + ([nav] if nav else [])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+# Картка товару (Markdown)
+def _build_product_card(product):
+    return (
+        f"🍕 *{product['name']}*\n\n"
+        f"📝 {product['desc']}\n\n"
+        f"💰 Ціна: *{product['price']} грн*"
+    )
+
+def product_card(product):
+    return renders.get(("card", product["id"]), _build_product_card, product)
+
+# ===== НАВІГАЦІЯ =====
+# Каталог живе в одному повідомленні-«екрані» на чат. Пам'ятаємо, що на ньому
+# зараз показано, і переходимо одним запитом: текст → текст через edit_text,
+# фото → фото через edit_message_media (або лише підпис, якщо фото те саме).
+# Ідентичний вміст не редагуємо взагалі. Перехід між текстом і фото в будь-який
+# бік — нове повідомлення з паралельним видаленням старого: інакше під текстом
+# без фото лишилась би чужа картинка.
+class Screen:
+    __slots__ = ("message_id", "photo", "text", "markup")
+
+    def __init__(self, message_id, photo=None, text=None, markup=None):
+        self.message_id = message_id
+        self.photo = photo
+        self.text = text
+        self.markup = markup
+
+class Screens:
+    def __init__(self, max_chats=10000):
+        self.max_chats = max_chats
+        self._screens = OrderedDict()
+        self.edits = 0
+        self.resent = 0
+        self.skipped = 0
+
+    def remember(self, message, text, markup, photo=None):
+        self._screens[message.chat.id] = Screen(message.message_id, photo, text, markup)
+        self._screens.move_to_end(message.chat.id)
+        while len(self._screens) > self.max_chats:
+            self._screens.popitem(last=False)
+
+    def _current(self, message):
+        screen = self._screens.get(message.chat.id)
+        if screen is None or screen.message_id != message.message_id:
+            # Невідоме (старе або після рестарту) повідомлення: знаємо лише його тип
+            photo = message.photo[-1].file_id if message.photo else None
+            screen = Screen(message.message_id, photo)
+        return screen
+
+    async def show(self, message, text, markup, photo=None):
+        """Показує text (і photo, якщо є) на місці повідомлення message."""
+        screen = self._current(message)
+        if (screen.photo is None) != (photo is None):
+            # Текст не перетворити на фото, а фото — на текст: шлемо нове
+            # повідомлення, а старе видаляємо паралельно, не чекаючи одне на одне
+            deleting = asyncio.create_task(self._delete(message))
+            try:
+                if photo:
+                    sent = await message.answer_photo(photo=photo, caption=text, parse_mode="Markdown", reply_markup=markup)
+                else:
+                    sent = await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+            finally:
+                await deleting
+            self.resent += 1
+            self.remember(sent, text, markup, photo)
+            return
+        if photo == screen.photo and text == screen.text and markup == screen.markup:
+            self.skipped += 1
+            return
+        try:
+            if photo != screen.photo:
+                await message.edit_media(
+                    InputMediaPhoto(media=photo, caption=text, parse_mode="Markdown"), reply_markup=markup
+                )
+            elif photo:
+                await message.edit_caption(caption=text, parse_mode="Markdown", reply_markup=markup)
+            else:
+                await message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        self.edits += 1
+        self.remember(message, text, markup, photo)
+
+    @staticmethod
+    async def _delete(message):
+        try:
+            await message.delete()
+        except TelegramBadRequest:
+            # Старіші за 48 годин повідомлення видалити не можна — лишаємо як є
+            pass
+
+    def stats(self):
+        return {"chats": len(self._screens), "edits": self.edits, "resent": self.resent, "skipped": self.skipped}
+
+screens = Screens()
+
 # ===== ХЕНДЛЕРИ =====
 
-@dp.message(Command("start"))
+@routes.command("start")
 async def start(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer(
@@ -293,7 +2557,7 @@ async def start(message: types.Message, state: FSMContext):
         reply_markup=main_menu
     )
 
-@dp.message(Command("admin"))
+@routes.command("admin")
 async def admin_panel(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         await message.answer("⛔️ У вас немає доступу!")
@@ -301,59 +2565,92 @@ async def admin_panel(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("👨‍💼 *Адмін панель*\n\nВиберіть дію:", parse_mode="Markdown", reply_markup=admin_menu)
 
-@dp.message(F.text == "◀️ Вийти з адмін панелі")
+@routes.text("◀️ Вийти з адмін панелі")
 async def exit_admin(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("Повернулись в головне меню 👇", reply_markup=main_menu)
 
 # Статистика
-@dp.message(F.text == "📊 Статистика")
+@routes.text("📊 Статистика")
 async def show_stats(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
-    stats = db_get_stats()
+    stats = await db_get_stats()
     await message.answer(
         f"📊 *Статистика магазину:*\n\n"
         f"📦 Всього замовлень: {stats['orders']}\n"
         f"💰 Загальна виручка: {stats['revenue']} грн\n"
         f"👤 Користувачів: {stats['users']}\n"
-        f"🍕 Товарів в меню: {stats['products']}",
+        f"🍕 Товарів в меню: {stats['products']}\n"
+        f"🧾 Середній чек: {stats['avg_check']} грн\n\n"
+        f"📅 Сьогодні: {stats['today'][0]} замовлень, {stats['today'][1]} грн\n"
+        f"📅 Вчора: {stats['yesterday'][0]} замовлень, {stats['yesterday'][1]} грн\n\n"
+        + top_products_text(stats["top"])
+        + await tech_stats_text(),
         parse_mode="Markdown"
     )
 
+def top_products_text(top):
+    if not top:
+        return ""
+    text = "🏆 *Топ товарів:*\n"
+    for i, (name, qty, revenue) in enumerate(top, start=1):
+        text += f"{i}. {name} — {qty} шт, {revenue} грн\n"
+    return text + "\n"
+
+# Технічні показники для адміна
+async def tech_stats_text():
+    pool = db.stats()
+    cache = menu.stats()
+    cart_stats = carts.stats()
+    send = outbox.stats()
+    lines = [
+        f"🗄 БД: пул {pool['size']}, вільно {pool['idle']}, в черзі {pool['waiting']}, "
+        f"очікування сер. {pool['wait_avg_ms']} мс / макс. {pool['wait_max_ms']} мс",
+        f"🗂 Кеш меню: v{cache['version']}, влучань {cache['hits']}, промахів {cache['misses']}",
+        f"🛒 Кошиків: {cart_stats['active']} в пам'яті, {cart_stats['spilled']} на диску",
+    ]
+    if isinstance(storage, SQLiteStorage):
+        fsm = storage.stats()
+        lines.append(f"🧭 FSM: {fsm['cached']} в кеші, влучань {fsm['hit_rate']:.0%}")
+    nav = screens.stats()
+    lines.append(f"🧭 Навігація: редагувань {nav['edits']}, нових повідомлень {nav['resent']}, пропущено {nav['skipped']}")
+    care = maintenance.stats()
+    lines.append(f"🧹 Обслуговування: бекап {care['last_backup'] or '—'}, архівовано {care['archived']}, "
+                 f"звільнено сторінок {care['vacuumed_pages']}")
+    group = writer.stats()
+    lines.append(f"✍️ Груповий коміт: записів {group['writes']}, транзакцій {group['batches']}, "
+                 f"сер. пачка {group['avg_batch']}")
+    flood = throttle.stats()
+    lines.append(f"🚦 Антифлуд: обмежено {flood['limited']}, дублікатів {flood['duplicates']}")
+    lines.append(f"🔀 Маршрути: {routes.size()}, через індекс {routes.routed}, повз {routes.unrouted}")
+    lines.append(
+        f"📤 Відправка: черга {send['queue_depth']}, повторів 429: {send['retries']}, "
+        f"затримка сер. {send['latency_avg_ms']} мс"
+    )
+    job_stats = await jobs.stats()
+    lines.append(f"📨 Задачі: в черзі {job_stats['pending']}, з помилкою {job_stats['failed']}")
+    return "\n".join(lines)
+
 # Всі товари
-@dp.message(F.text == "📋 Всі товари")
+@routes.text("📋 Всі товари")
 async def all_products(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
-    text = "📋 *Всі товари:*\n\n"
-    cat_names = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
-    for cat_key, cat_name in cat_names.items():
-        products = db_get_products(cat_key)
-        if products:
-            text += f"*{cat_name}:*\n"
-            for p in products:
-                photo_status = "📸" if p["photo"] else "🚫"
-                text += f"  {photo_status} ID:{p['id']} | {p['name']} — {p['price']} грн\n"
-            text += "\n"
-    await message.answer(text, parse_mode="Markdown")
+    text, markup = await product_page("list", "all")
+    await message.answer(text, parse_mode="Markdown", reply_markup=markup)
 
 # Додати фото
-@dp.message(F.text == "📸 Додати фото")
+@routes.text("📸 Додати фото")
 async def add_photo_start(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return
-    text = "📋 *Товари без фото:*\n\n"
-    cat_names = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
-    for cat_key in cat_names:
-        for p in db_get_products(cat_key):
-            if not p["photo"]:
-                text += f"ID:{p['id']} | {p['name']}\n"
-    text += "\nВведіть ID товару:"
+    text, markup = await product_page("photo", "nophoto")
     await state.set_state(AdminPhoto.product_id)
-    await message.answer(text, parse_mode="Markdown", reply_markup=cancel_keyboard)
+    await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+    await message.answer("Введіть ID товару:", reply_markup=cancel_keyboard)
 
-@dp.message(AdminPhoto.product_id)
+@routes.state(AdminPhoto.product_id)
 async def admin_photo_get_id(message: types.Message, state: FSMContext):
     if message.text == "❌ Скасувати":
         await state.clear()
@@ -362,7 +2659,7 @@ async def admin_photo_get_id(message: types.Message, state: FSMContext):
     if not message.text.isdigit():
         await message.answer("⚠️ Введіть тільки ID!")
         return
-    product = db_get_product(int(message.text))
+    product = menu.get(int(message.text))
     if not product:
         await message.answer("⚠️ Товар не знайдено!")
         return
@@ -370,31 +2667,30 @@ async def admin_photo_get_id(message: types.Message, state: FSMContext):
     await state.set_state(AdminPhoto.photo)
     await message.answer(f"Надішліть фото для *{product['name']}*:", parse_mode="Markdown", reply_markup=cancel_keyboard)
 
-@dp.message(AdminPhoto.photo, F.photo)
+@routes.state(AdminPhoto.photo, F.photo)
 async def admin_save_photo(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    product = db_get_product(data["product_id"])
-    db_update_photo(data["product_id"], message.photo[-1].file_id)
+    product = menu.get(data["product_id"])
+    await menu.set_photo(data["product_id"], message.photo[-1].file_id)
     await message.answer(f"✅ Фото для *{product['name']}* збережено!", parse_mode="Markdown", reply_markup=admin_menu)
     await state.clear()
 
 # Додати товар
-@dp.message(F.text == "➕ Додати товар")
+@routes.text("➕ Додати товар")
 async def add_product_start(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return
     await state.set_state(AdminAdd.category)
     await message.answer("Виберіть категорію:", reply_markup=admin_category_keyboard())
 
-@dp.callback_query(F.data.startswith("admin_cat_"))
-async def admin_choose_category(callback: types.CallbackQuery, state: FSMContext):
-    category = callback.data.replace("admin_cat_", "")
-    await state.update_data(category=category)
+@routes.callback(AdminCategoryCallback)
+async def admin_choose_category(callback: types.CallbackQuery, callback_data: AdminCategoryCallback, state: FSMContext):
+    await state.update_data(category=callback_data.category)
     await state.set_state(AdminAdd.name)
     await callback.message.answer("Введіть назву товару:", reply_markup=cancel_keyboard)
     await callback.answer()
 
-@dp.message(AdminAdd.name)
+@routes.state(AdminAdd.name)
 async def admin_get_name(message: types.Message, state: FSMContext):
     if message.text == "❌ Скасувати":
         await state.clear()
@@ -404,7 +2700,7 @@ async def admin_get_name(message: types.Message, state: FSMContext):
     await state.set_state(AdminAdd.price)
     await message.answer("Введіть ціну (тільки цифри):")
 
-@dp.message(AdminAdd.price)
+@routes.state(AdminAdd.price)
 async def admin_get_price(message: types.Message, state: FSMContext):
     if message.text == "❌ Скасувати":
         await state.clear()
@@ -417,7 +2713,7 @@ async def admin_get_price(message: types.Message, state: FSMContext):
     await state.set_state(AdminAdd.desc)
     await message.answer("Введіть опис товару:")
 
-@dp.message(AdminAdd.desc)
+@routes.state(AdminAdd.desc)
 async def admin_get_desc(message: types.Message, state: FSMContext):
     if message.text == "❌ Скасувати":
         await state.clear()
@@ -427,27 +2723,26 @@ async def admin_get_desc(message: types.Message, state: FSMContext):
     await state.set_state(AdminAdd.photo)
     await message.answer("Надішліть фото або пропустіть:", reply_markup=skip_keyboard)
 
-@dp.message(AdminAdd.photo, F.photo)
+@routes.state(AdminAdd.photo, F.photo)
 async def admin_get_photo(message: types.Message, state: FSMContext):
     await state.update_data(photo=message.photo[-1].file_id)
     await save_new_product(message, state)
 
-@dp.message(AdminAdd.photo, F.text == "⏭ Пропустити фото")
+@routes.text("⏭ Пропустити фото", AdminAdd.photo)
 async def admin_skip_photo(message: types.Message, state: FSMContext):
     await state.update_data(photo=None)
     await save_new_product(message, state)
 
 async def save_new_product(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    product_id = db_add_product(data["name"], data["price"], data["desc"], data.get("photo"), data["category"])
-    cat_names = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
+    product_id = await menu.add(data["name"], data["price"], data["desc"], data.get("photo"), data["category"])
     await message.answer(
         f"✅ *Товар додано!*\n\n"
         f"ID: {product_id}\n"
         f"📦 {data['name']}\n"
         f"💰 {data['price']} грн\n"
         f"📝 {data['desc']}\n"
-        f"📂 {cat_names[data['category']]}\n"
+        f"📂 {CATEGORY_NAMES[data['category']]}\n"
         f"📸 Фото: {'✅' if data.get('photo') else '🚫 немає'}",
         parse_mode="Markdown",
         reply_markup=admin_menu
@@ -455,23 +2750,31 @@ async def save_new_product(message: types.Message, state: FSMContext):
     await state.clear()
 
 # Видалити товар
-@dp.message(F.text == "🗑 Видалити товар")
+@routes.text("🗑 Видалити товар")
 async def delete_product_start(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return
-    text = "📋 Введіть ID товару для видалення:\n\n"
-    cat_names = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
-    for cat_key, cat_name in cat_names.items():
-        products = db_get_products(cat_key)
-        if products:
-            text += f"*{cat_name}:*\n"
-            for p in products:
-                text += f"  ID:{p['id']} | {p['name']}\n"
-            text += "\n"
+    text, markup = await product_page("delete", "all")
     await state.set_state(AdminDelete.product_id)
-    await message.answer(text, parse_mode="Markdown", reply_markup=cancel_keyboard)
+    await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+    await message.answer("Введіть ID товару для видалення:", reply_markup=cancel_keyboard)
+
+# Гортання списків товарів: редагуємо те саме повідомлення
+@routes.callback(PageCallback)
+async def product_page_nav(callback: types.CallbackQuery, callback_data: PageCallback):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    text, markup = await product_page(callback_data.mode, callback_data.flt, callback_data.cursor, callback_data.dir)
+    try:
+        await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
+    except TelegramBadRequest as e:
+        # Натиснули на вже вибраний фільтр — сторінка та сама
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
 
-@dp.message(AdminDelete.product_id)
+@routes.state(AdminDelete.product_id)
 async def admin_delete_product(message: types.Message, state: FSMContext):
     if message.text == "❌ Скасувати":
         await state.clear()
@@ -480,103 +2783,260 @@ async def admin_delete_product(message: types.Message, state: FSMContext):
     if not message.text.isdigit():
         await message.answer("⚠️ Введіть тільки ID!")
         return
-    product = db_get_product(int(message.text))
+    product = menu.get(int(message.text))
     if not product:
         await message.answer("⚠️ Товар не знайдено!")
         return
-    db_delete_product(int(message.text))
+    await menu.delete(int(message.text))
     await message.answer(f"✅ Товар *{product['name']}* видалено!", parse_mode="Markdown", reply_markup=admin_menu)
     await state.clear()
 
+# ===== ІМПОРТ / ЕКСПОРТ =====
+IMPORT_HELP = (
+    "📥 *Імпорт меню*\n\n"
+    "Надішліть файл CSV (колонки `id,category,name,price,desc`) або JSON Lines "
+    "(по одному об'єкту з тими ж полями в рядку).\n\n"
+    "• рядок з `id` оновлює існуючий товар\n"
+    "• рядок без `id` додає новий\n"
+    "• категорії: pizza, drinks, desserts\n\n"
+    "Шаблон — експорт товарів з меню 📤 Експорт."
+)
+
+def read_menu_file(path, file_name):
+    """Читає файл рядок за рядком і повертає (номер_рядка, dict)."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if file_name.lower().endswith((".json", ".jsonl", ".ndjson")):
+            first = f.read(1)
+            f.seek(0)
+            if first == "[":
+                # Звичайний JSON-масив читаємо цілком — такі файли невеликі
+                yield from enumerate(json.load(f), start=1)
+                return
+            for line_no, line in enumerate(f, start=1):
+                if line.strip():
+                    yield line_no, json.loads(line)
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+def validate_menu_file(path, file_name):
+    inserts, updates, errors = [], [], []
+    unchanged = 0
+    seen = set()
+    try:
+        for line_no, row in read_menu_file(path, file_name):
+            row = {str(k).strip().lower(): ("" if v is None else str(v).strip()) for k, v in row.items()}
+            name, price, desc, category = row.get("name", ""), row.get("price", ""), row.get("desc", ""), row.get("category", "")
+            raw_id = row.get("id", "")
+            if not name:
+                errors.append(f"рядок {line_no}: порожня назва")
+                continue
+            if not price.isdigit() or int(price) <= 0:
+                errors.append(f"рядок {line_no}: ціна «{price}» не є додатним числом")
+                continue
+            if category not in CATEGORY_NAMES:
+                errors.append(f"рядок {line_no}: невідома категорія «{category}»")
+                continue
+            if raw_id:
+                if not raw_id.isdigit() or int(raw_id) not in menu.by_id:
+                    errors.append(f"рядок {line_no}: товару з ID {raw_id} немає")
+                    continue
+                product_id = int(raw_id)
+                if product_id in seen:
+                    errors.append(f"рядок {line_no}: ID {product_id} повторюється")
+                    continue
+                seen.add(product_id)
+                old = menu.by_id[product_id]
+                if (old["name"], old["price"], old["desc"] or "", old["category"]) == (name, int(price), desc, category):
+                    unchanged += 1
+                else:
+                    updates.append((name, int(price), desc, category, product_id))
+            else:
+                inserts.append((name, int(price), desc, category))
+    except (ValueError, AttributeError, UnicodeDecodeError, csv.Error) as e:
+        errors.append(f"не вдалося прочитати файл: {e}")
+    return inserts, updates, unchanged, errors
+
+@routes.text("📥 Імпорт меню")
+async def import_start(message: types.Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await state.set_state(AdminImport.file)
+    await message.answer(IMPORT_HELP, parse_mode="Markdown", reply_markup=cancel_keyboard)
+
+@routes.state(AdminImport.file, F.document)
+async def import_file(message: types.Message, state: FSMContext):
+    document = message.document
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(document.file_name or "")[1])
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        inserts, updates, unchanged, errors = await asyncio.to_thread(validate_menu_file, path, document.file_name or "")
+    finally:
+        os.remove(path)
+    if errors:
+        text = "⚠️ *Імпорт не виконано*, виправте помилки:\n\n" + "\n".join(errors[:15])
+        if len(errors) > 15:
+            text += f"\n… і ще {len(errors) - 15}"
+        await message.answer(text, parse_mode="Markdown")
+        return
+    await menu.bulk_apply(inserts, updates)
+    await state.clear()
+    await message.answer(
+        f"✅ *Імпорт завершено*\n\n"
+        f"➕ Додано: {len(inserts)}\n"
+        f"✏️ Оновлено: {len(updates)}\n"
+        f"➖ Без змін: {unchanged}",
+        parse_mode="Markdown",
+        reply_markup=admin_menu
+    )
+
+@routes.state(AdminImport.file)
+async def import_waiting(message: types.Message, state: FSMContext):
+    if message.text == "❌ Скасувати":
+        await state.clear()
+        await message.answer("Скасовано.", reply_markup=admin_menu)
+        return
+    await message.answer("⚠️ Надішліть файл CSV або JSON Lines.")
+
+def _build_export_keyboard():
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🍕 Товари", callback_data="export_products")],
+        [InlineKeyboardButton(text="📦 Замовлення за 7 днів", callback_data=ExportOrdersCallback(days=7).pack())],
+        [InlineKeyboardButton(text="📦 Замовлення за 30 днів", callback_data=ExportOrdersCallback(days=30).pack())],
+        [InlineKeyboardButton(text="📦 Всі замовлення", callback_data=ExportOrdersCallback(days=0).pack())],
+    ])
+
+def export_keyboard():
+    return renders.get("export", _build_export_keyboard)
+
+@routes.text("📤 Експорт")
+async def export_start(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(
+        "📤 Що вивантажити?\n\nДовільний період: /export\\_orders 01.02.2026 28.02.2026",
+        parse_mode="Markdown",
+        reply_markup=export_keyboard()
+    )
+
+async def send_export(chat_id, file_name, export, *args):
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        count = await export(path, *args)
+        await bot.send_document(chat_id, types.FSInputFile(path, filename=file_name), caption=f"Рядків: {count}")
+    finally:
+        os.remove(path)
+
+@routes.callback("export_products")
+async def export_products(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    await callback.answer("⏳ Готуємо файл…")
+    await send_export(callback.from_user.id, "products.csv", db_export_products)
+
+@routes.callback(ExportOrdersCallback)
+async def export_orders(callback: types.CallbackQuery, callback_data: ExportOrdersCallback):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    days = callback_data.days
+    date_to = int(time.time()) + 1
+    date_from = date_to - days * 86400 if days else 0
+    await callback.answer("⏳ Готуємо файл…")
+    await send_export(callback.from_user.id, f"orders-{days or 'all'}.csv", db_export_orders, date_from, date_to)
+
+@routes.command("export_orders")
+async def export_orders_range(message: types.Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        start, end = (command.args or "").split()
+        date_from = int(datetime.strptime(start, "%d.%m.%Y").timestamp())
+        date_to = int((datetime.strptime(end, "%d.%m.%Y") + timedelta(days=1)).timestamp())
+    except ValueError:
+        await message.answer("⚠️ Формат: /export_orders 01.02.2026 28.02.2026")
+        return
+    await send_export(message.chat.id, f"orders-{start}-{end}.csv", db_export_orders, date_from, date_to)
+
 # Каталог
-@dp.message(F.text == "🛍 Каталог")
+@routes.text("🛍 Каталог", throttle="browse")
 async def catalog(message: types.Message):
-    await message.answer("Виберіть категорію:", reply_markup=catalog_keyboard())
-
-@dp.callback_query(F.data.startswith("cat_"))
-async def show_category(callback: types.CallbackQuery):
-    category = callback.data.replace("cat_", "")
-    names = {"pizza": "🍕 Піца", "drinks": "🥤 Напої", "desserts": "🍰 Десерти"}
-    await callback.message.edit_text(f"{names[category]}:", reply_markup=products_keyboard(category))
+    markup = catalog_keyboard()
+    sent = await message.answer("Виберіть категорію:", reply_markup=markup)
+    screens.remember(sent, "Виберіть категорію:", markup)
+
+@routes.callback(CategoryCallback, throttle="browse")
+async def show_category(callback: types.CallbackQuery, callback_data: CategoryCallback):
+    category = callback_data.category
+    await screens.show(callback.message, f"{CATEGORY_NAMES[category]}:", products_keyboard(category))
+
+# Уся категорія одним альбомом: один виклик API замість картки на кожен товар
+@routes.callback(GalleryCallback, throttle="browse")
+async def show_gallery(callback: types.CallbackQuery, callback_data: GalleryCallback):
+    albums = category_gallery(callback_data.category)
+    if not albums:
+        await callback.answer("📷 У цій категорії ще немає фото", show_alert=True)
+        return
+    await callback.answer()
+    for album in albums:
+        await callback.message.answer_media_group(album)
 
-@dp.callback_query(F.data == "back_catalog")
+@routes.callback("back_catalog", throttle="browse")
+@routes.callback("continue_shopping", throttle="browse")
 async def back_to_catalog(callback: types.CallbackQuery):
-    if callback.message.photo:
-        await callback.message.delete()
-        await callback.message.answer("Виберіть категорію:", reply_markup=catalog_keyboard())
-    else:
-        await callback.message.edit_text("Виберіть категорію:", reply_markup=catalog_keyboard())
-
-@dp.callback_query(F.data == "continue_shopping")
-async def continue_shopping(callback: types.CallbackQuery):
-    if callback.message.photo:
-        await callback.message.delete()
-        await callback.message.answer("Виберіть категорію:", reply_markup=catalog_keyboard())
-    else:
-        await callback.message.edit_text("Виберіть категорію:", reply_markup=catalog_keyboard())
+    await screens.show(callback.message, "Виберіть категорію:", catalog_keyboard())
 
-@dp.callback_query(F.data.startswith("product_"))
-async def show_product(callback: types.CallbackQuery):
-    product_id = int(callback.data.replace("product_", ""))
-    product = db_get_product(product_id)
+@routes.callback(ProductCallback, throttle="browse")
+async def show_product(callback: types.CallbackQuery, callback_data: ProductCallback):
+    product_id = callback_data.id
+    product = menu.get(product_id)
     if product:
-        text = (
-            f"🍕 *{product['name']}*\n\n"
-            f"📝 {product['desc']}\n\n"
-            f"💰 Ціна: *{product['price']} грн*"
-        )
-        if product["photo"]:
-            await callback.message.delete()
-            await callback.message.answer_photo(
-                photo=product["photo"],
-                caption=text,
-                parse_mode="Markdown",
-                reply_markup=add_to_cart_keyboard(product_id)
-            )
-        else:
-            await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=add_to_cart_keyboard(product_id))
+        await screens.show(callback.message, product_card(product), add_to_cart_keyboard(product_id), product["photo"])
 
-@dp.callback_query(F.data.startswith("add_"))
-async def add_to_cart(callback: types.CallbackQuery):
+@routes.callback(AddCallback, throttle="cart")
+async def add_to_cart(callback: types.CallbackQuery, callback_data: AddCallback):
     user_id = callback.from_user.id
-    product_id = int(callback.data.replace("add_", ""))
-    product = db_get_product(product_id)
-    if user_id not in carts:
-        carts[user_id] = []
-    for item in carts[user_id]:
-        if item["id"] == product_id:
-            item["qty"] += 1
-            await callback.answer(f"✅ {product['name']} ще раз додано!", show_alert=True)
-            return
-    carts[user_id].append({"id": product_id, "name": product["name"], "price": product["price"], "qty": 1})
+    product_id = callback_data.id
+    product = menu.get(product_id)
+    if product is None:
+        await callback.answer("😔 Цього товару вже немає в меню", show_alert=True)
+        return
+    qty = await carts.add(user_id, product)
+    if qty > 1:
+        await callback.answer(f"✅ {product['name']} ще раз додано!", show_alert=True)
+        return
     await callback.answer(f"✅ {product['name']} додано в кошик!", show_alert=True)
 
 # Кошик
-@dp.message(F.text == "🛒 Кошик")
+@routes.text("🛒 Кошик")
 async def show_cart(message: types.Message):
-    user_id = message.from_user.id
-    if user_id not in carts or len(carts[user_id]) == 0:
+    cart = await carts.items(message.from_user.id)
+    if not cart:
         await message.answer("🛒 Ваш кошик порожній!", reply_markup=main_menu)
         return
     text = "🛒 *Ваш кошик:*\n\n"
     total = 0
-    for item in carts[user_id]:
+    for item in cart:
         subtotal = item["price"] * item["qty"]
         total += subtotal
         text += f"• {item['name']} x{item['qty']} — {subtotal} грн\n"
     text += f"\n💰 *Разом: {total} грн*"
     await message.answer(text, parse_mode="Markdown", reply_markup=cart_keyboard())
 
-@dp.callback_query(F.data == "clear_cart")
+@routes.callback("clear_cart", throttle="cart")
 async def clear_cart(callback: types.CallbackQuery):
-    carts[callback.from_user.id] = []
+    await carts.clear(callback.from_user.id)
     await callback.message.edit_text("🗑 Кошик очищено!")
     await callback.answer()
 
 # Мої замовлення
-@dp.message(F.text == "📦 Мої замовлення")
+@routes.text("📦 Мої замовлення")
 async def my_orders(message: types.Message):
-    orders = db_get_user_orders(message.from_user.id)
+    orders = await db_get_user_orders(message.from_user.id)
     if not orders:
         await message.answer("📦 У вас ще немає замовлень!", reply_markup=main_menu)
         return
@@ -584,17 +3044,17 @@ async def my_orders(message: types.Message):
     for o in orders:
         text += (
             f"🔸 *Замовлення №{o[0]}*\n"
-            f"📅 {o[3]}\n"
+            f"📅 {datetime.fromtimestamp(o[3]).strftime('%d.%m.%Y %H:%M') if o[3] else o[5]}\n"
             f"💰 Сума: {o[2]} грн\n"
-            f"📊 Статус: {o[4]}\n\n"
+            f"📊 Статус: {STATUS_ICONS.get(o[4], '')} {o[4]}\n\n"
         )
     await message.answer(text, parse_mode="Markdown")
 
 # Оформлення замовлення
-@dp.callback_query(F.data == "checkout")
+@routes.callback("checkout")
 async def checkout(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    if user_id not in carts or len(carts[user_id]) == 0:
+    if await carts.is_empty(user_id):
         await callback.answer("Кошик порожній!", show_alert=True)
         return
     await state.set_state(OrderForm.name)
@@ -605,43 +3065,93 @@ async def checkout(callback: types.CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@dp.message(F.text == "❌ Скасувати")
+@routes.text("❌ Скасувати")
 async def cancel_order(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("❌ Скасовано.", reply_markup=main_menu)
 
-@dp.message(OrderForm.name)
+@routes.state(OrderForm.name)
 async def get_name(message: types.Message, state: FSMContext):
     await state.update_data(name=message.text)
     await state.set_state(OrderForm.phone)
     await message.answer("Крок 2 з 3\n\n📞 Введіть номер телефону:")
 
-@dp.message(OrderForm.phone)
+@routes.state(OrderForm.phone)
 async def get_phone(message: types.Message, state: FSMContext):
     await state.update_data(phone=message.text)
     await state.set_state(OrderForm.address)
     await message.answer("Крок 3 з 3\n\n📍 Введіть адресу доставки:")
 
-@dp.message(OrderForm.address)
+@routes.state(OrderForm.address)
 async def get_address(message: types.Message, state: FSMContext):
     await state.update_data(address=message.text)
-    data = await state.get_data()
-    user_id = message.from_user.id
-    cart = carts.get(user_id, [])
+    await place_order(message, state, message.from_user)
+
+@routes.callback("confirm_order", OrderForm.confirm)
+async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await place_order(callback.message, state, callback.from_user)
+
+def _build_confirm_keyboard():
+    return PrebuiltMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Підтвердити замовлення", callback_data="confirm_order")]
+    ])
+
+def confirm_keyboard():
+    return renders.get("confirm", _build_confirm_keyboard)
+
+def order_text(cart):
     total = sum(i["price"] * i["qty"] for i in cart)
     items_text = ""
     for item in cart:
         items_text += f"• {item['name']} x{item['qty']} — {item['price'] * item['qty']} грн\n"
+    return items_text, total
 
-    order_id = db_save_order(
-        user_id,
-        message.from_user.username or "",
+async def place_order(message: types.Message, state: FSMContext, user: types.User):
+    data = await state.get_data()
+    cart = await carts.items(user.id)
+    if not cart:
+        await state.clear()
+        await message.answer("🛒 Ваш кошик порожній!", reply_markup=main_menu)
+        return
+    items_text, total = order_text(cart)
+
+    order_id, changes = await db_save_order(
+        user.id,
+        user.username or "",
         data["name"],
         data["phone"],
         data["address"],
+        cart,
         items_text,
         total
     )
+    if changes:
+        # Меню змінилось, поки клієнт оформлював: оновлюємо кошик і просимо підтвердити
+        await carts.reprice(user.id, {item["id"]: product for item, product in changes})
+        text = "⚠️ *Поки ви оформлювали замовлення, меню змінилось:*\n\n"
+        for item, product in changes:
+            if product is None:
+                text += f"• {item['name']} — більше немає, прибрали з кошика\n"
+            else:
+                text += f"• {item['name']} — ціна {item['price']} → {product['price']} грн\n"
+        cart = await carts.items(user.id)
+        if not cart:
+            await state.clear()
+            await message.answer(text + "\n🛒 Кошик тепер порожній.", parse_mode="Markdown", reply_markup=main_menu)
+            return
+        items_text, total = order_text(cart)
+        await state.set_state(OrderForm.confirm)
+        await message.answer(
+            text + f"\n🛒 *Ваше замовлення:*\n{items_text}\n💰 *Разом: {total} грн*",
+            parse_mode="Markdown",
+            reply_markup=confirm_keyboard()
+        )
+        return
+    # Замовлення вже в БД: сповіщення адміну піде з черги задач
+    jobs.wake()
+    await carts.clear(user.id)
+    await state.clear()
 
     await message.answer(
         f"✅ *Замовлення №{order_id} прийнято!*\n\n"
@@ -656,23 +3166,505 @@ async def get_address(message: types.Message, state: FSMContext):
         reply_markup=main_menu
     )
 
-    await bot.send_message(
-        ADMIN_ID,
-        f"🔔 *НОВЕ ЗАМОВЛЕННЯ №{order_id}!*\n\n"
-        f"👤 Ім'я: {data['name']}\n"
-        f"📞 Телефон: {data['phone']}\n"
-        f"📍 Адреса: {data['address']}\n\n"
-        f"🛒 *Склад замовлення:*\n{items_text}\n"
-        f"💰 *Сума: {total} грн*\n\n"
-        f"👤 Telegram ID: {user_id}",
+# ===== ЗАДАЧІ ПІСЛЯ ЗАМОВЛЕННЯ =====
+@jobs.handler("notify_admin")
+async def job_notify_admin(p):
+    board.touch()
+    await notify_admin(
+        f"🔔 *НОВЕ ЗАМОВЛЕННЯ №{p['order_id']}!*\n\n"
+        f"👤 Ім'я: {p['name']}\n"
+        f"📞 Телефон: {p['phone']}\n"
+        f"📍 Адреса: {p['address']}\n\n"
+        f"🛒 *Склад замовлення:*\n{p['items_text']}\n"
+        f"💰 *Сума: {p['total']} грн*\n\n"
+        f"👤 Telegram ID: {p['user_id']}",
         parse_mode="Markdown"
     )
 
-    carts[user_id] = []
-    await state.clear()
+# Оновлюємо лічильник замовлень користувача (перерахунок, тож повтор задачі безпечний)
+def _update_user_counter(conn, user_id, username, name):
+    is_new = conn.execute("SELECT 1 FROM users WHERE telegram_id=?", (user_id,)).fetchone() is None
+    conn.execute("""
+        INSERT INTO users (telegram_id, username, first_name, order_count)
+        VALUES (?, ?, ?, (SELECT COUNT(*) FROM main.orders WHERE user_id = ?)
+                       + (SELECT COUNT(*) FROM archive.orders WHERE user_id = ?))
+        ON CONFLICT(telegram_id) DO UPDATE SET order_count = excluded.order_count
+    """, (user_id, username, name, user_id, user_id))
+    if is_new:
+        conn.execute("UPDATE stats_counters SET value = value + 1 WHERE key='users'")
+
+@jobs.handler("user_counter")
+async def job_user_counter(p):
+    await writer.submit(_update_user_counter, p["user_id"], p["username"], p["name"])
+
+# ===== МЕДІА =====
+# Масова реєстрація фото з папки MEDIA_DIR: файл "12.jpg" — товар з ID 12,
+# "Чотири сири.jpg" чи "чотири_сири.png" — товар з такою назвою. Кожен
+# унікальний (за sha256) файл завантажується в Telegram один раз, а file_id
+# зберігається в таблиці media; далі фото надсилаються лише за file_id.
+MEDIA_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+MEDIA_MAX_BYTES = 10 * 1024 * 1024
+
+def scan_media(directory):
+    """[(path, stem, sha256)] для фото в папці; хеш рахується потоково."""
+    files = []
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        stem, ext = os.path.splitext(entry.name)
+        if not entry.is_file() or ext.lower() not in MEDIA_EXTENSIONS or entry.stat().st_size > MEDIA_MAX_BYTES:
+            continue
+        digest = hashlib.sha256()
+        with open(entry.path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+        files.append((entry.path, stem, digest.hexdigest()))
+    return files
+
+def match_product(stem, by_name):
+    if stem.isdigit():
+        return menu.get(int(stem))
+    return by_name.get(stem.replace("_", " ").strip().casefold())
+
+async def upload_photo(path):
+    """Завантажує файл у чат адміна (тихо), забирає file_id і прибирає повідомлення."""
+    token = send_priority.set(PRIORITY_BULK)
+    try:
+        sent = await bot.send_photo(ADMIN_ID, types.FSInputFile(path), disable_notification=True)
+        await bot.delete_message(ADMIN_ID, sent.message_id)
+    finally:
+        send_priority.reset(token)
+    photo = sent.photo[-1]
+    return photo.file_id, photo.file_unique_id
+
+async def sync_media(directory=MEDIA_DIR):
+    files = await asyncio.to_thread(scan_media, directory)
+    by_name = {p["name"].casefold(): p for p in menu.by_id.values()}
+    matched, unknown = [], []
+    for path, stem, digest in files:
+        product = match_product(stem, by_name)
+        if product:
+            matched.append((product, path, digest))
+        else:
+            unknown.append(os.path.basename(path))
+    file_ids = await db_media_file_ids({digest for _, _, digest in matched})
+    cached = sum(1 for _, _, digest in matched if digest in file_ids)
+    uploaded = 0
+    for _, path, digest in matched:
+        if digest not in file_ids:
+            file_id, unique_id = await upload_photo(path)
+            await db_save_media(digest, file_id, unique_id, path)
+            file_ids[digest] = file_id
+            uploaded += 1
+    photos = {p["id"]: file_ids[digest] for p, _, digest in matched if p["photo"] != file_ids[digest]}
+    if photos:
+        await menu.set_photos(photos)
+    return {"files": len(files), "uploaded": uploaded, "cached": cached, "updated": len(photos), "unknown": unknown}
+
+@routes.text("🖼 Фото з папки")
+async def media_sync(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not os.path.isdir(MEDIA_DIR):
+        await message.answer(
+            f"📁 Папки `{MEDIA_DIR}` немає. Покладіть туди фото з назвами `ID.jpg` або `Назва товару.jpg`.",
+            parse_mode="Markdown"
+        )
+        return
+    await message.answer("⏳ Реєструємо фото…")
+    result = await sync_media()
+    text = (
+        f"🖼 *Фото з папки*\n\n"
+        f"Файлів: {result['files']}\n"
+        f"Завантажено: {result['uploaded']}, з кешу: {result['cached']}\n"
+        f"Оновлено товарів: {result['updated']}"
+    )
+    if result["unknown"]:
+        text += "\n\n⚠️ Без товару: " + ", ".join(f"`{name}`" for name in result["unknown"][:20])
+    await message.answer(text, parse_mode="Markdown", reply_markup=admin_menu)
+
+# ===== ОБСЛУГОВУВАННЯ БАЗИ =====
+# Фонова задача лідера раз на MAINTENANCE_INTERVAL:
+#  - переносить замовлення, старші за ARCHIVE_AFTER_DAYS, в архівну базу
+#    (спершу копія, окремою транзакцією — видалення, тож збій дає лише дубль);
+#  - повертає вільні сторінки інкрементальним vacuum;
+#  - раз на BACKUP_INTERVAL робить онлайн-копію обох баз через backup API.
+# Кожен крок обмежений MAINTENANCE_PAGES сторінок або замовлень.
+class BackupRestarted(Exception):
+    pass
+
+def backup_database(source, target, pages, pause=0.01):
+    """Копіює source у target кроками по pages сторінок з паузою між ними; повертає кількість рестартів."""
+    partial = target + ".part"
+    src = sqlite3.connect(source, timeout=10)
+    dst = sqlite3.connect(partial)
+    restarts = 0
+    left = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, left
+        # Запис з іншого з'єднання починає копію спочатку. Якщо трафік не дає
+        # дійти до кінця, копіюємо одним кроком: у WAL читач не блокує запис
+        if left is not None and remaining > left:
+            restarts += 1
+            if restarts >= 3:
+                raise BackupRestarted
+        left = remaining
+        # sleep= у backup() спрацьовує лише на SQLITE_BUSY, тож темп тримаємо самі
+        if remaining:
+            time.sleep(pause)
+
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except BackupRestarted:
+            src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(partial, target)
+    return restarts
+
+def _copy_to_archive(conn, before, batch):
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM main.orders WHERE created_at < ? ORDER BY created_at LIMIT ?", (before, batch)
+    )]
+    if ids:
+        marks = ",".join("?" * len(ids))
+        conn.execute(
+            f"INSERT OR IGNORE INTO archive.orders ({ORDER_COLUMNS}) "
+            f"SELECT {ORDER_COLUMNS} FROM main.orders WHERE id IN ({marks})", ids
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO archive.order_items (id, order_id, product_id, name, qty, price) "
+            f"SELECT id, order_id, product_id, name, qty, price FROM main.order_items WHERE order_id IN ({marks})", ids
+        )
+    return ids
+
+def _drop_archived(conn, ids):
+    marks = ",".join("?" * len(ids))
+    archived = f"SELECT id FROM archive.orders WHERE id IN ({marks})"
+    conn.execute(f"DELETE FROM main.order_items WHERE order_id IN ({archived})", ids)
+    conn.execute(f"DELETE FROM main.orders WHERE id IN ({archived})", ids)
+
+def _incremental_vacuum(conn, pages):
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not free:
+        return 0
+    # execute() робить лише один крок PRAGMA (одну сторінку), executescript — до кінця
+    conn.executescript(f"PRAGMA incremental_vacuum({pages})")
+    return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+class Maintenance:
+    def __init__(self, interval=MAINTENANCE_INTERVAL, pages=MAINTENANCE_PAGES, archive_days=ARCHIVE_AFTER_DAYS,
+                 backup_interval=BACKUP_INTERVAL, backup_dir=BACKUP_DIR, backup_keep=BACKUP_KEEP):
+        self.interval = interval
+        self.pages = pages
+        self.archive_days = archive_days
+        self.backup_interval = backup_interval
+        self.backup_dir = backup_dir
+        self.backup_keep = backup_keep
+        self._task = None
+        self.archived = 0
+        self.vacuumed = 0
+        self.backups = 0
+        self.backup_restarts = 0
+        self.last_backup = None
+
+    async def archive(self):
+        if not self.archive_days:
+            return 0
+        before = int(time.time()) - self.archive_days * 86400
+        moved = 0
+        while True:
+            ids = await db.run(_copy_to_archive, before, self.pages)
+            if not ids:
+                break
+            await db.run(_drop_archived, ids)
+            moved += len(ids)
+            await asyncio.sleep(0)
+        self.archived += moved
+        return moved
+
+    async def vacuum(self):
+        freed = 0
+        while True:
+            pages = await db.run(_incremental_vacuum, self.pages)
+            if not pages:
+                break
+            freed += pages
+            await asyncio.sleep(0)
+        self.vacuumed += freed
+        return freed
+
+    async def backup(self):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        paths = []
+        for source in (DB_PATH, ARCHIVE_PATH):
+            if not os.path.exists(source):
+                continue
+            name = os.path.splitext(os.path.basename(source))[0]
+            target = os.path.join(self.backup_dir, f"{name}-{stamp}.db")
+            self.backup_restarts += await asyncio.to_thread(backup_database, source, target, self.pages)
+            self._prune(name)
+            paths.append(target)
+        await db_set_setting("last_backup", str(int(time.time())))
+        self.backups += 1
+        self.last_backup = stamp
+        return paths
+
+    def _prune(self, name):
+        pattern = re.compile(rf"^{re.escape(name)}-\d{{8}}-\d{{6}}\.db$")
+        old = sorted(f for f in os.listdir(self.backup_dir) if pattern.match(f))[:-self.backup_keep]
+        for file_name in old:
+            os.remove(os.path.join(self.backup_dir, file_name))
+
+    async def run_once(self):
+        moved = await self.archive()
+        freed = await self.vacuum()
+        if moved or freed:
+            print(f"🗄 Архівовано замовлень: {moved}, звільнено сторінок: {freed}")
+        if self.backup_interval:
+            last = await db_get_setting("last_backup")
+            if not last or time.time() - int(last) >= self.backup_interval:
+                await self.backup()
+
+    async def _loop(self):
+        # Перший прохід — не одразу після старту, щоб не заважати прогріву
+        await asyncio.sleep(min(60, self.interval))
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"⚠️ Обслуговування БД: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "archived": self.archived,
+            "vacuumed_pages": self.vacuumed,
+            "backups": self.backups,
+            "backup_restarts": self.backup_restarts,
+            "last_backup": self.last_backup,
+        }
+
+maintenance = Maintenance()
+metrics.gauge("bot_archived_orders_total", lambda: maintenance.archived, "counter")
+metrics.gauge("bot_vacuumed_pages_total", lambda: maintenance.vacuumed, "counter")
+metrics.gauge("bot_backups_total", lambda: maintenance.backups, "counter")
+
+# ===== ДОШКА ЗАМОВЛЕНЬ =====
+# Одне закріплене повідомлення в чаті адміна зі списком активних замовлень.
+# Натискання не пишуться в БД одразу: за flush_interval вони збираються в
+# пачку і застосовуються однією транзакцією, після чого дошка редагується на місці.
+class OrderBoard:
+    def __init__(self, chat_id=ADMIN_ID, size=15, flush_interval=1.0):
+        self.chat_id = chat_id
+        self.size = size
+        self.flush_interval = flush_interval
+        self.message_id = None
+        self._pending = {}
+        self._stale = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.batches = 0
+        self.updated = 0
+
+    async def load(self):
+        value = await db_get_setting("order_board")
+        self.message_id = int(value) if value else None
+
+    async def set_status(self, order_ids, status):
+        """Ставить зміни в чергу. Повертає {order_id: поточний статус} для пропущених:
+        замовлення вже на цьому статусі чи далі (або зникло)."""
+        current = await db_order_statuses(order_ids)
+        skipped = {}
+        for order_id in order_ids:
+            # Ще не записане натискання новіше за БД
+            now = self._pending.get(order_id, current.get(order_id))
+            if now is None or status_rank(status) <= status_rank(now):
+                skipped[order_id] = now
+            else:
+                self._pending[order_id] = status
+        if len(skipped) < len(order_ids):
+            self._wakeup.set()
+        return skipped
+
+    def touch(self):
+        self._stale = True
+        self._wakeup.set()
+
+    async def render(self):
+        counts, orders = await db_active_orders(self.size)
+        lines = [f"🗂 Дошка замовлень · {datetime.now().strftime('%H:%M:%S')}", ""]
+        lines.append(" · ".join(f"{STATUS_ICONS[s]} {s}: {counts.get(s, 0)}" for s in ACTIVE_STATUSES))
+        lines.append("")
+        rows = []
+        for order_id, name, total, status, created_at in orders:
+            at = datetime.fromtimestamp(created_at).strftime("%H:%M") if created_at else ""
+            lines.append(f"#{order_id} {STATUS_ICONS[status]} {name} — {total} грн {at}")
+            next_status = ORDER_STATUSES[ORDER_STATUSES.index(status) + 1]
+            rows.append([InlineKeyboardButton(
+                text=f"#{order_id} → {STATUS_ICONS[next_status]} {next_status}",
+                callback_data=StatusCallback(order_id=order_id, status=ORDER_STATUSES.index(next_status)).pack()
+            )])
+        if not orders:
+            lines.append("Активних замовлень немає 🎉")
+        hidden = sum(counts.values()) - len(orders)
+        if hidden > 0:
+            lines.append(f"… і ще {hidden}")
+        for index, status in enumerate(ACTIVE_STATUSES):
+            if counts.get(status):
+                rows.append([InlineKeyboardButton(
+                    text=f"⏩ Всі «{status}» → {ORDER_STATUSES[index + 1]} ({counts[status]})",
+                    callback_data=BoardCallback(action=str(index)).pack()
+                )])
+        rows.append([InlineKeyboardButton(text="🔄 Оновити", callback_data=BoardCallback(action="refresh").pack())])
+        return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+    async def post(self):
+        """Надсилає нову дошку вниз чату, закріплює її і видаляє попередню."""
+        text, markup = await self.render()
+        message = await notify_admin(text, reply_markup=markup)
+        old, self.message_id = self.message_id, message.message_id
+        await db_set_setting("order_board", str(message.message_id))
+        token = send_priority.set(PRIORITY_ADMIN)
+        try:
+            await bot.pin_chat_message(self.chat_id, message.message_id, disable_notification=True)
+            if old:
+                await bot.delete_message(self.chat_id, old)
+        except TelegramBadRequest:
+            pass
+        finally:
+            send_priority.reset(token)
+
+    async def refresh(self):
+        if not self.message_id:
+            return
+        text, markup = await self.render()
+        token = send_priority.set(PRIORITY_ADMIN)
+        try:
+            await bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            if "message to edit not found" not in str(e):
+                raise
+            # Дошку видалили вручну — ставимо нову
+            self.message_id = None
+            await self.post()
+        finally:
+            send_priority.reset(token)
+
+    async def flush(self):
+        if self._pending:
+            changes, self._pending = list(self._pending.items()), {}
+            try:
+                changed = await writer.submit(_set_order_statuses, changes)
+            except Exception:
+                # Новіші натискання перекривають ті, що не записались
+                self._pending = {**dict(changes), **self._pending}
+                raise
+            self.batches += 1
+            self.updated += changed
+            if changed:
+                jobs.wake()
+                self._stale = True
+        if self._stale:
+            self._stale = False
+            await self.refresh()
+
+    async def _loop(self):
+        while True:
+            await self._wakeup.wait()
+            # Чекаємо ще натискань, щоб записати їх однією транзакцією і один раз оновити дошку
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Дошка замовлень: {e}")
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+board = OrderBoard()
+
+@routes.text("🗂 Замовлення")
+async def show_board(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await board.post()
+
+@routes.callback(StatusCallback)
+async def board_set_status(callback: types.CallbackQuery, callback_data: StatusCallback):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    status = ORDER_STATUSES[callback_data.status]
+    skipped = await board.set_status([callback_data.order_id], status)
+    if skipped:
+        current = skipped[callback_data.order_id]
+        await callback.answer(f"⚠️ #{callback_data.order_id} вже «{current}», пропущено" if current
+                              else f"⚠️ #{callback_data.order_id} не знайдено")
+        board.touch()
+        return
+    await callback.answer(f"#{callback_data.order_id} → {status}")
+
+@routes.callback(BoardCallback)
+async def board_bulk(callback: types.CallbackQuery, callback_data: BoardCallback):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    action = callback_data.action
+    if action == "refresh":
+        board.touch()
+        await callback.answer()
+        return
+    index = int(action)
+    order_ids = await db_order_ids_with_status(ORDER_STATUSES[index])
+    skipped = await board.set_status(order_ids, ORDER_STATUSES[index + 1])
+    text = f"{len(order_ids) - len(skipped)} замовлень → {ORDER_STATUSES[index + 1]}"
+    if skipped:
+        listed = ", ".join(f"#{order_id}" for order_id in list(skipped)[:10])
+        more = f" і ще {len(skipped) - 10}" if len(skipped) > 10 else ""
+        text += f"\nПропущено {len(skipped)} (вже далі): {listed}{more}"
+    await callback.answer(text, show_alert=bool(skipped))
+
+# Сповіщення клієнта про новий статус. Розсилка йде з найнижчим пріоритетом,
+# тож масова зміна статусів не гальмує відповіді в чатах.
+@jobs.handler("notify_status")
+async def job_notify_status(p):
+    token = send_priority.set(PRIORITY_BULK)
+    try:
+        await bot.send_message(
+            p["user_id"],
+            f"{STATUS_ICONS[p['status']]} Замовлення №{p['order_id']}: {p['status']}"
+        )
+    except TelegramForbiddenError:
+        # Клієнт заблокував бота — повторювати немає сенсу
+        pass
+    finally:
+        send_priority.reset(token)
 
 # Контакти
-@dp.message(F.text == "📞 Контакти")
+@routes.text("📞 Контакти")
 async def contacts(message: types.Message):
     await message.answer(
         "📞 *Контакти:*\n\n"
@@ -684,26 +3676,407 @@ async def contacts(message: types.Message):
     )
     
 
-async def main():
-    init_db()
-    print("✅ База даних підключена!")
-    print("✅ Бот запущен!")
-    
-    from aiohttp import web
+# ===== ПОШУК =====
+# Inline-режим (@bot марг) треба увімкнути в @BotFather командою /setinline
+@dp.inline_query()
+async def inline_search(query: types.InlineQuery):
+    results = []
+    # Порожній запит — показуємо початок меню
+    products = menu.search(query.query, limit=20) if query.query.strip() else list(menu.by_id.values())[:20]
+    for p in products:
+        if p["photo"]:
+            results.append(types.InlineQueryResultCachedPhoto(
+                id=str(p["id"]),
+                photo_file_id=p["photo"],
+                title=p["name"],
+                caption=product_card(p),
+                parse_mode="Markdown",
+                reply_markup=inline_product_keyboard(p["id"]),
+            ))
+        else:
+            results.append(types.InlineQueryResultArticle(
+                id=str(p["id"]),
+                title=f"{p['name']} — {p['price']} грн",
+                description=p["desc"],
+                input_message_content=types.InputTextMessageContent(message_text=product_card(p), parse_mode="Markdown"),
+                reply_markup=inline_product_keyboard(p["id"]),
+            ))
+    await query.answer(results, cache_time=60)
+
+# Будь-який інший текст поза сценаріями — пошук по меню
+@dp.message(StateFilter(None), F.text, ~F.text.startswith("/"))
+async def text_search(message: types.Message):
+    products = menu.search(message.text, limit=10)
+    if not products:
+        await message.answer("🔍 Нічого не знайдено. Спробуйте іншу назву або відкрийте 🛍 Каталог.", reply_markup=main_menu)
+        return
+    await message.answer(f"🔍 Знайдено: {len(products)}", reply_markup=search_keyboard(products))
+
+# ===== ВЕБХУК =====
+# Апдейти обробляються паралельно, але для одного користувача — строго по черзі:
+# кожна нова задача чекає попередню задачу цього ж чату. Загальна кількість
+# задач в роботі обмежена MAX_INFLIGHT, далі вебхук чекає (backpressure).
+class UpdateScheduler:
+    def __init__(self, limit=MAX_INFLIGHT, process=None):
+        self.limit = limit
+        # Що робити з апдейтом: обробити тут або (в роутері) переслати воркеру
+        self.process = process or self._feed
+        self._slots = asyncio.Semaphore(limit)
+        self._chains = {}
+        self._tasks = set()
+        self.processed = 0
+        self.failed = 0
+
+    @staticmethod
+    def chat_key(update):
+        event = update.event
+        user = getattr(event, "from_user", None)
+        if user:
+            return user.id
+        chat = getattr(event, "chat", None)
+        return chat.id if chat else None
+
+    async def submit(self, update):
+        await self._slots.acquire()
+        key = self.chat_key(update)
+        prev = self._chains.get(key)
+        task = asyncio.create_task(self._run(update, prev, key))
+        self._chains[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, update, prev, key):
+        try:
+            if prev:
+                await asyncio.wait([prev])
+            await self.process(update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠️ Помилка обробки апдейту {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+            if self._chains.get(key) is asyncio.current_task():
+                del self._chains[key]
+
+    @staticmethod
+    async def _feed(update):
+        await dp.feed_update(bot, update)
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def stats(self):
+        return {"in_flight": len(self._tasks), "limit": self.limit, "processed": self.processed, "failed": self.failed}
+
+updates = UpdateScheduler()
+metrics.gauge("bot_updates_in_flight", lambda: updates.stats()["in_flight"])
+
+async def webhook_handler(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    # Апдейт, що прийшов під час старту, чекає прогріву; 503 — Telegram повторить пізніше
+    if not await wait_ready():
+        return web.Response(status=503)
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    await updates.submit(update)
+    return web.Response(text="OK")
+
+# ===== КІЛЬКА ВОРКЕРІВ =====
+# Роутер приймає апдейти (вебхук або polling) і пересилає кожен воркеру за
+# ключем чату: апдейти одного користувача завжди йдуть в той самий процес і по
+# черзі, тож кеші кошиків і FSM у воркері лишаються вірними. Спільний стан — у
+# SQLite (WAL) або Redis. Черга задач і дошка замовлень працюють лише у воркері,
+# якому належить чат адміна, щоб задачі не виконувались двічі.
+def shard_of(key, workers=WORKERS):
+    return (key or 0) % workers
+
+IS_LEADER = WORKER_ID is None or shard_of(ADMIN_ID) == WORKER_ID
+
+class ShardRouter:
+    def __init__(self, urls, secret=WORKER_SECRET, retry_for=30.0):
+        self.urls = urls
+        self.secret = secret
+        self.retry_for = retry_for
+        self._session = None
+        self.forwarded = [0] * len(urls)
+        self.retries = 0
+
+    async def forward(self, update):
+        if self._session is None:
+            self._session = ClientSession()
+        shard = shard_of(UpdateScheduler.chat_key(update), len(self.urls))
+        payload = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+        deadline = time.monotonic() + self.retry_for
+        while True:
+            # Воркер відповідає, щойно поставив апдейт у свою чергу, тож порядок
+            # апдейтів чату зберігається, а обробка не блокує роутер
+            try:
+                async with self._session.post(
+                    f"{self.urls[shard]}/update", json=payload, headers={"X-Worker-Secret": self.secret}
+                ) as response:
+                    if response.status == 200:
+                        self.forwarded[shard] += 1
+                        return
+                    error = f"HTTP {response.status}"
+            except ClientError as e:
+                error = repr(e)
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"воркер {shard} недоступний: {error}")
+            # Воркер перезапускається — чекаємо його, апдейти чату стоять у черзі
+            self.retries += 1
+            await asyncio.sleep(0.5)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    def stats(self):
+        return {"workers": len(self.urls), "forwarded": self.forwarded, "retries": self.retries}
+
+# Локальні воркери: роутер запускає їх дочірніми процесами і перезапускає, якщо впали
+class WorkerProcesses:
+    def __init__(self, count, port=WORKER_PORT):
+        self.count = count
+        self.port = port
+        self._procs = {}
+        self._tasks = []
+        self._stopping = False
+
+    @property
+    def urls(self):
+        return [f"http://127.0.0.1:{self.port + i}" for i in range(self.count)]
+
+    async def _supervise(self, worker_id):
+        env = dict(os.environ, WORKER_ID=str(worker_id), WORKERS=str(self.count),
+                   PORT=str(self.port + worker_id), WORKER_SECRET=WORKER_SECRET)
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self._procs[worker_id] = proc
+            code = await proc.wait()
+            if not self._stopping:
+                print(f"⚠️ Воркер {worker_id} завершився з кодом {code}, перезапускаємо")
+                await asyncio.sleep(1)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(i)) for i in range(self.count)]
+
+    async def stop(self):
+        self._stopping = True
+        for proc in self._procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+        for proc in self._procs.values():
+            try:
+                await asyncio.wait_for(proc.wait(), 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+        for task in self._tasks:
+            task.cancel()
+
+async def worker_update_handler(request):
+    if request.headers.get("X-Worker-Secret") != WORKER_SECRET:
+        return web.Response(status=401)
+    if not await wait_ready():
+        return web.Response(status=503)
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    await updates.submit(update)
+    return web.Response(text="OK")
+
+async def poll_updates():
+    """Long polling без Dispatcher: роутер лише забирає апдейти і передає далі."""
+    offset = None
+    allowed = dp.resolve_used_update_types()
+    while True:
+        try:
+            batch = await bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed)
+        except Exception as e:
+            print(f"⚠️ getUpdates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in batch:
+            await updates.submit(update)
+            offset = update.update_id + 1
+
+# Готовність: порт і / відповідають одразу, а апдейти приймаються лише після
+# міграцій і прогріву кешів (GET /ready віддає 503, поки не готові).
+# Платформи (render.yaml, railway.json) перевіряють живість по /: повільний
+# старт чи зависла БД не мають призводити до перезапусків. /ready — лише для
+# окремих readiness-проб (k8s, балансувальники), де вони є
+ready = asyncio.Event()
+startup_seconds = 0.0
+
+async def startup():
+    global startup_seconds
+    started = time.perf_counter()
+    # Міграції — синхронний sqlite3, тож у потоці, щоб не блокувати health-check
+    await asyncio.to_thread(run_migrations)
+    await db.open()
+    # Кеші незалежні — гріємо паралельно на різних з'єднаннях пулу
+    await asyncio.gather(menu.load(), carts.load(), board.load() if IS_LEADER else asyncio.sleep(0))
+    carts.start()
+    if isinstance(storage, SQLiteStorage):
+        storage.start()
+    if IS_LEADER:
+        jobs.start()
+        board.start()
+        maintenance.start()
+        asyncio.create_task(backfill_orders())
+    if WORKER_ID is not None:
+        menu.watch()
+    startup_seconds = time.perf_counter() - started
+    ready.set()
+    print(f"✅ Готовий за {startup_seconds * 1000:.0f} мс")
+
+async def wait_ready(timeout=30):
+    try:
+        await asyncio.wait_for(ready.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+metrics.gauge("bot_ready", lambda: int(ready.is_set()))
+metrics.gauge("bot_startup_seconds", lambda: round(startup_seconds, 3))
+
+async def shutdown():
+    await updates.drain()
+    await maintenance.stop()
+    await board.stop()
+    await jobs.stop()
+    await menu.stop()
+    await carts.stop()
+    await storage.close()
+    await writer.stop()
+    await outbox.close()
+    await bot.session.close()
+    await db.close()
+
+async def health(request):
+    return web.Response(text="OK")
+
+async def readiness(request):
+    if not ready.is_set():
+        return web.Response(status=503, text="starting")
+    return web.Response(text="READY")
+
+async def start_web(routes, port):
+    global early_server
     app = web.Application()
-    async def health(request):
-        return web.Response(text="OK")
     app.router.add_get("/", health)
-    
+    app.router.add_get("/ready", readiness)
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
     runner = web.AppRunner(app)
     await runner.setup()
-    port = int(os.getenv("PORT", 10000))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    if early_server and early_server.server_address[1] == port:
+        # Зупиняємо тимчасовий сервер, але не закриваємо сокет: з'єднання, що
+        # прийдуть у цей момент, дочекаються в черзі прийому і їх прийме aiohttp
+        await asyncio.to_thread(early_server.shutdown)
+        site = web.SockSite(runner, early_server.socket)
+        early_server = None
+    else:
+        site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
-    
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
-   
+    return runner
+
+def stop_event():
+    """Подія, яка спрацьовує на SIGTERM/SIGINT, щоб встигнути зберегти стан."""
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    return event
+
+async def receive_updates():
+    if BOT_MODE == "webhook" and WEBHOOK_BASE:
+        # Вебхук не видаляємо при зупинці: Telegram притримає апдейти до рестарту
+        await bot.set_webhook(
+            WEBHOOK_BASE.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=False,
+        )
+        print(f"✅ Вебхук: {WEBHOOK_BASE.rstrip('/')}{WEBHOOK_PATH}")
+        await stop_event().wait()
+        return
+    if BOT_MODE == "webhook":
+        print("⚠️ WEBHOOK_URL не задано, працюємо через polling")
+    await bot.delete_webhook(drop_pending_updates=False)
+    if updates.process is UpdateScheduler._feed:
+        await dp.start_polling(bot)
+        return
+    polling = asyncio.create_task(poll_updates())
+    await stop_event().wait()
+    polling.cancel()
+
+async def run_router():
+    await asyncio.to_thread(run_migrations)
+    processes = None
+    if WORKER_URLS:
+        urls = WORKER_URLS
+    else:
+        processes = WorkerProcesses(WORKERS)
+        processes.start()
+        urls = processes.urls
+    shards = ShardRouter(urls)
+    updates.process = shards.forward
+    # Роутер стану не тримає; воркер, що ще стартує, сам притримає апдейт
+    ready.set()
+    metrics.gauge("bot_router_retries_total", lambda: shards.retries, "counter")
+    print(f"✅ Роутер запущено, воркерів: {len(urls)}")
+
+    runner = await start_web([
+        ("POST", WEBHOOK_PATH, webhook_handler),
+        ("GET", "/metrics", metrics_handler),
+    ], int(os.getenv("PORT", 10000)))
+    try:
+        await receive_updates()
+    finally:
+        await runner.cleanup()
+        await updates.drain()
+        await shards.close()
+        if processes:
+            await processes.stop()
+        await bot.session.close()
+
+async def run_worker():
+    runner = await start_web([
+        ("POST", "/update", worker_update_handler),
+        ("GET", "/metrics", metrics_handler),
+    ], int(os.getenv("PORT", WORKER_PORT + WORKER_ID)))
+    try:
+        await startup()
+        print(f"✅ Воркер {WORKER_ID + 1}/{WORKERS} запущено{' (задачі і дошка замовлень)' if IS_LEADER else ''}")
+        await stop_event().wait()
+    finally:
+        await runner.cleanup()
+        await shutdown()
+
+async def main():
+    if WORKER_ID is not None:
+        await run_worker()
+        return
+    if WORKERS > 1 or WORKER_URLS:
+        await run_router()
+        return
+
+    # Спершу порт: платформа бачить живий сервіс, поки йдуть міграції і прогрів
+    runner = await start_web([
+        ("POST", WEBHOOK_PATH, webhook_handler),
+        ("GET", "/metrics", metrics_handler),
+    ], int(os.getenv("PORT", 10000)))
+    try:
+        await startup()
+        print("✅ Бот запущен!")
+        await receive_updates()
+    finally:
+        await runner.cleanup()
+        await shutdown()
+
 
 if __name__ == "__main__":
     asyncio.run(main())